@@ -0,0 +1,155 @@
+"""Замеры производительности lmdi_calc.py на синтетических данных разного масштаба.
+
+Для каждого масштаба (объекты x годы x топлива) данные создаются create_sample_data.py,
+затем замеряются стадии load, convert, decompose и render (лучшее время из --repeat).
+Масштаб с одним объектом считается одиночным рядом, с несколькими - панелью.
+
+    python benchmark_lmdi.py --scales 1x12x7,1000x30x7 --save-baseline benchmark_baseline.json
+    python benchmark_lmdi.py --scales 1x12x7,1000x30x7 --compare benchmark_baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import lmdi_calc
+from create_sample_data import ENTITY_COLUMN, generate_data, save_data
+
+DEFAULT_SCALES = '1x12x7,100x12x7,1000x30x7,10000x30x7'
+
+
+def parse_scale(text):
+    """'1000x30x7' -> (1000, 30, 7)"""
+    try:
+        n_entities, n_years, n_fuels = (int(part) for part in text.lower().split('x'))
+    except ValueError:
+        raise ValueError(f"Invalid scale '{text}'. Use <entities>x<years>x<fuels>, e.g. 1000x30x7.")
+    return n_entities, n_years, n_fuels
+
+
+def run_once(path, n_entities, start_year, end_year, render, out_dir):
+    """Один прогон всех стадий; возвращает записи стадий RunProfiler"""
+    entity_column = ENTITY_COLUMN if n_entities > 1 else None
+    profiler = lmdi_calc.RunProfiler(trace_memory=False)
+
+    with profiler.stage('load') as info:
+        df = lmdi_calc.load_data(path, start_year=start_year, end_year=end_year, entity_column=entity_column)
+        info['rows'] = len(df)
+    with profiler.stage('convert'):
+        lmdi_df = lmdi_calc.convert_units(df)
+    with profiler.stage('decompose') as info:
+        if entity_column:
+            results_df = lmdi_calc.decompose_panel(lmdi_df, start_year, end_year)
+            results_overall = None
+        else:
+            terms = lmdi_calc.series_terms(lmdi_df)
+            results_df = lmdi_calc.decompose_periods(terms, 'chained')
+            results_overall = lmdi_calc.overall_results(terms, start_year, end_year)
+        info['periods'] = len(results_df)
+    # Графики строятся для одиночного ряда; у панели их число растет с числом объектов
+    if render and not entity_column:
+        with profiler.stage('render') as info:
+            jobs = lmdi_calc.chart_jobs(results_df, results_overall, lmdi_df, start_year, end_year,
+                                        out_dir=out_dir, verbose=False)
+            info['charts'] = len(lmdi_calc.render_charts(jobs, processes=1))
+    return profiler.stages
+
+
+def benchmark(scales, repeat=3, file_format='csv', render=True, edge_cases=True, seed=42):
+    """Лучшее время каждой стадии по масштабам: {масштаб: {стадия: секунды}}"""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in scales:
+            n_entities, n_years, n_fuels = parse_scale(scale)
+            df = generate_data(n_entities if n_entities > 1 else None, n_years, n_fuels,
+                               edge_cases=edge_cases, seed=seed)
+            path = os.path.join(tmp_dir, f'{scale}.{file_format}')
+            save_data(df, path)
+            start_year, end_year = int(df['Year'].min()), int(df['Year'].max())
+
+            timings = {}
+            for _ in range(repeat):
+                for record in run_once(path, n_entities, start_year, end_year, render, tmp_dir):
+                    timings.setdefault(record['name'], []).append(record['wall_s'])
+            results[scale] = {name: min(values) for name, values in timings.items()}
+            print(f"{scale}: " + ', '.join(f"{name} {seconds:.4f} s" for name, seconds in results[scale].items()),
+                  file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Таблица текущих и базовых времен; список регрессий (масштаб, стадия, отношение)"""
+    rows, regressions = [], []
+    for scale, stages in results.items():
+        for name, seconds in stages.items():
+            base = baseline.get(scale, {}).get(name)
+            ratio = seconds / base if base else np.nan
+            rows.append({'Scale': scale, 'Stage': name, 'Seconds': seconds, 'Baseline': base, 'Ratio': ratio})
+            if base and ratio > 1 + tolerance:
+                regressions.append((scale, name, ratio))
+    return pd.DataFrame(rows), regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the LMDI pipeline on synthetic data.")
+    parser.add_argument('--scales', default=DEFAULT_SCALES,
+                        help=f"comma-separated <entities>x<years>x<fuels> (default: {DEFAULT_SCALES})")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per scale, best time is kept (default: 3)")
+    parser.add_argument('--format', choices=['xlsx', 'csv', 'parquet'], default='csv',
+                        help="input file format (default: csv)")
+    parser.add_argument('--no-render', action='store_true', help="skip the chart rendering stage")
+    parser.add_argument('--no-edge-cases', action='store_true', help="generate data without edge cases")
+    parser.add_argument('--save-baseline', help="save timings to this JSON file")
+    parser.add_argument('--compare', help="compare timings with this baseline JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed slowdown against the baseline before failing (default: 0.2 = 20%%)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        scales = [scale.strip() for scale in args.scales.split(',') if scale.strip()]
+        for scale in scales:
+            parse_scale(scale)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        return 1
+
+    results = benchmark(scales, args.repeat, args.format, not args.no_render, not args.no_edge_cases)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    table, regressions = compare(results, baseline, args.tolerance)
+    print(table.to_string(index=False, float_format='%.4f'))
+
+    if args.save_baseline:
+        report = {
+            'machine': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'format': args.format,
+            'repeat': args.repeat,
+            'results': results,
+        }
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if regressions:
+        for scale, name, ratio in regressions:
+            print(f"REGRESSION: {scale} {name} is {ratio:.2f}x the baseline time")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,53 +1,130 @@
+"""Синтетические данные для LMDI-анализа.
+
+Без аргументов создает sample_manufacturing_data.xlsx (12 лет, 7 топлив, seed 42), как раньше.
+Для замеров производительности задаются число объектов, лет и топлив, формат файла и
+крайние случаи, попадающие в ветки epsilon функции log_mean:
+    python create_sample_data.py --entities 1000 --years 30 --format parquet --edge-cases
+"""
+import argparse
+import os
+
 import pandas as pd
 import numpy as np
 
-# Create sample data for LMDI analysis
-years = list(range(2012, 2024))
-n_years = len(years)
-
-# Generate realistic manufacturing data
-np.random.seed(42)
-
-# Base values for different energy sources (in their respective units)
-coal_base = 500 + np.random.normal(0, 50, n_years)
-gas_base = 1000 + np.random.normal(0, 100, n_years)
-residual_oil_base = 200 + np.random.normal(0, 20, n_years)
-diesel_base = 150 + np.random.normal(0, 15, n_years)
-gasoline_base = 100 + np.random.normal(0, 10, n_years)
-electricity_base = 5000 + np.random.normal(0, 500, n_years)
-heat_base = 300 + np.random.normal(0, 30, n_years)
-
-# Production and economic indicators
-production_output = 1000 + np.cumsum(np.random.normal(20, 50, n_years))
-gva_manufacturing = 50000 + np.cumsum(np.random.normal(1000, 2000, n_years))
-gdp_country = 1000000 + np.cumsum(np.random.normal(20000, 50000, n_years))
-
-# Create the dataset
-data = {
-    'Year': years,
-    'Coal_manufacturing_consumption (thousand tonnes)': np.maximum(0, coal_base).round(1),
-    'Gas_manufacturing_consumption (mln m3)': np.maximum(0, gas_base).round(1),
-    'Residual_Oil_manufacturing_consumption (thousand tonnes)': np.maximum(0, residual_oil_base).round(1),
-    'Diesel_manufacturing_consumption (thousand tonnes)': np.maximum(0, diesel_base).round(1),
-    'Gasoline_manufacturing_consumption (thousand tonnes)': np.maximum(0, gasoline_base).round(1),
-    'Electricity_manufacturing_Consumption (mln kWh)': np.maximum(0, electricity_base).round(1),
-    'Heat_manufacturing_consumption (thousand gigacalories)': np.maximum(0, heat_base).round(1),
-    'Production Output (thousand tonne)': np.maximum(0, production_output).round(1),
-    'GVA_manufacturing USD': np.maximum(0, gva_manufacturing).round(0),
-    'GDP_country (USD)': np.maximum(0, gdp_country).round(0)
-}
-
-# Create DataFrame
-df = pd.DataFrame(data)
-
-# Save to Excel file
-output_file = 'sample_manufacturing_data.xlsx'
-df.to_excel(output_file, sheet_name='Sheet1', index=False)
-
-print(f"Sample data created successfully!")
-print(f"File saved as: {output_file}")
-print(f"Data shape: {df.shape}")
-print("\nFirst few rows:")
-print(df.head())
-print("\nData summary:")
-print(df.describe())
\ No newline at end of file
+# Колонки потребления топлив (как col_mapping в lmdi_calc.py) и средние значения в их единицах
+FUEL_COLUMNS = [
+    ('Coal_manufacturing_consumption (thousand tonnes)', 500, 50),
+    ('Gas_manufacturing_consumption (mln m3)', 1000, 100),
+    ('Residual_Oil_manufacturing_consumption (thousand tonnes)', 200, 20),
+    ('Diesel_manufacturing_consumption (thousand tonnes)', 150, 15),
+    ('Gasoline_manufacturing_consumption (thousand tonnes)', 100, 10),
+    ('Electricity_manufacturing_Consumption (mln kWh)', 5000, 500),
+    ('Heat_manufacturing_consumption (thousand gigacalories)', 300, 30),
+]
+ENTITY_COLUMN = 'Entity'
+
+
+def generate_data(n_entities=None, n_years=12, n_fuels=len(FUEL_COLUMNS), start_year=2012,
+                  edge_cases=False, seed=42):
+    """DataFrame входных данных: по строке на (объект, год).
+
+    n_entities=None - одиночный ряд без колонки объекта; иначе колонка ENTITY_COLUMN.
+    n_fuels - сколько первых топлив потребляется, остальные колонки нулевые.
+    edge_cases=True добавляет крайние случаи: Gasoline равен нулю во все годы, Diesel
+    появляется с середины периода, Residual_Oil исчезает, у Coal и выпуска
+    совпадают значения двух соседних лет.
+    """
+    if not 1 <= n_fuels <= len(FUEL_COLUMNS):
+        raise ValueError(f"n_fuels must be between 1 and {len(FUEL_COLUMNS)}.")
+    rng = np.random.RandomState(seed)
+    n_rows = n_entities or 1
+    years = np.arange(start_year, start_year + n_years)
+    shape = (n_rows, n_years)
+
+    # Base values for different energy sources (in their respective units)
+    fuels = {col: mean + rng.normal(0, sd, shape) for col, mean, sd in FUEL_COLUMNS}
+
+    # Production and economic indicators
+    production_output = 1000 + np.cumsum(rng.normal(20, 50, shape), axis=1)
+    gva_manufacturing = 50000 + np.cumsum(rng.normal(1000, 2000, shape), axis=1)
+    gdp_country = 1000000 + np.cumsum(rng.normal(20000, 50000, shape), axis=1)
+
+    if n_entities:
+        # Объекты разного масштаба
+        scale = rng.lognormal(0.0, 1.0, (n_rows, 1))
+        fuels = {col: values * scale for col, values in fuels.items()}
+        production_output = production_output * scale
+        gva_manufacturing = gva_manufacturing * scale
+    for col, _, _ in FUEL_COLUMNS[n_fuels:]:
+        fuels[col] = np.zeros(shape)
+
+    if edge_cases:
+        names = [col for col, _, _ in FUEL_COLUMNS]
+        half = n_years // 2
+        fuels[names[4]][:] = 0.0  # Gasoline: нет потребления
+        fuels[names[3]][:, :half] = 0.0  # Diesel: появляется
+        fuels[names[2]][:, half:] = 0.0  # Residual_Oil: исчезает
+        if n_years > 1:
+            fuels[names[0]][:, 1] = fuels[names[0]][:, 0]  # Coal: равные соседние значения
+            production_output[:, 1] = production_output[:, 0]
+
+    # Create the dataset
+    data = {}
+    if n_entities:
+        width = len(str(n_entities - 1))
+        data[ENTITY_COLUMN] = np.repeat([f'E{i:0{width}d}' for i in range(n_entities)], n_years)
+    data['Year'] = np.tile(years, n_rows)
+    for col, values in fuels.items():
+        data[col] = np.maximum(0, values).round(1).ravel()
+    data['Production Output (thousand tonne)'] = np.maximum(0, production_output).round(1).ravel()
+    data['GVA_manufacturing USD'] = np.maximum(0, gva_manufacturing).round(0).ravel()
+    data['GDP_country (USD)'] = np.maximum(0, np.broadcast_to(gdp_country, shape)).round(0).ravel()
+    return pd.DataFrame(data)
+
+
+def save_data(df, output_file):
+    """Сохраняет в Excel (Sheet1), CSV или Parquet по расширению файла"""
+    suffix = os.path.splitext(output_file)[1].lower()
+    if suffix == '.csv':
+        df.to_csv(output_file, index=False)
+    elif suffix in ('.parquet', '.pq'):
+        df.to_parquet(output_file, index=False)
+    else:
+        df.to_excel(output_file, sheet_name='Sheet1', index=False)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic input data for lmdi_calc.py.")
+    parser.add_argument('--entities', type=int,
+                        help=f"number of entities (adds an '{ENTITY_COLUMN}' column; default: single series)")
+    parser.add_argument('--years', type=int, default=12, help="number of years (default: 12)")
+    parser.add_argument('--start-year', type=int, default=2012, help="first year (default: 2012)")
+    parser.add_argument('--fuels', type=int, default=len(FUEL_COLUMNS),
+                        help=f"number of consumed fuels, 1-{len(FUEL_COLUMNS)} (default: all)")
+    parser.add_argument('--edge-cases', action='store_true',
+                        help="add zero, appearing, disappearing and constant fuels")
+    parser.add_argument('--seed', type=int, default=42, help="random seed (default: 42)")
+    parser.add_argument('--format', choices=['xlsx', 'csv', 'parquet'], default='xlsx',
+                        help="output format (default: xlsx)")
+    parser.add_argument('--output', help="output file (default: sample_manufacturing_data.<format>)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    df = generate_data(args.entities, args.years, args.fuels, args.start_year, args.edge_cases, args.seed)
+
+    output_file = args.output or f'sample_manufacturing_data.{args.format}'
+    save_data(df, output_file)
+
+    print(f"Sample data created successfully!")
+    print(f"File saved as: {output_file}")
+    print(f"Data shape: {df.shape}")
+    print("\nFirst few rows:")
+    print(df.head())
+    print("\nData summary:")
+    print(df.describe())
+
+
+if __name__ == '__main__':
+    main()
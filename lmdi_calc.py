@@ -1,44 +1,321 @@
-import pandas as pd
+"""LMDI-разложение выбросов CO2 обрабатывающей промышленности.
+
+Загрузка, пересчет единиц, разложение и построение графиков доступны как функции;
+графические библиотеки импортируются только при построении графиков.
+
+Запуск из командной строки:
+    python lmdi_calc.py dataset_raw.xlsx --sheet Sheet1 --start-year 2012 --end-year 2023
+"""
+import argparse
+import contextlib
+import glob
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from matplotlib.gridspec import GridSpec
+import pandas as pd
 
-# === Configuration ===
-FILE_PATH = r"C:\Users\timur\OneDrive\Documents\dataset_raw.xlsx"  # УКАЖИТЕ ВАШ ПУТЬ К ФАЙЛУ
+# === Configuration (значения по умолчанию для CLI) ===
 SHEET_NAME = 'Sheet1'
 START_YEAR = 2012
 END_YEAR = 2023
 EPSILON = 1e-9
 
+
+# === Instrumentation: Stage Timings and Memory ===
+class RunProfiler:
+    """Замеры стадий расчета: время, процессорное время, пиковая память и размеры данных.
+
+    with profiler.stage('convert') as info: ... ; info['rows'] = len(df)
+    hooks - вызываемые объекты hook(event, record), event - 'start' или 'end';
+    record - словарь стадии (на 'start' только name). trace_memory=False отключает
+    tracemalloc, который заметно замедляет выделение памяти. Пик памяти считается
+    от начала стадии, поэтому стадии не вкладываются друг в друга.
+    """
+
+    def __init__(self, hooks=(), trace_memory=True):
+        self.hooks = list(hooks)
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.started_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name, **counts):
+        record = {'name': name}
+        for hook in self.hooks:
+            hook('start', record)
+        info = dict(counts)
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        elif self.trace_memory:
+            tracemalloc.reset_peak()
+        children = os.times()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield info
+        finally:
+            record['wall_s'] = time.perf_counter() - wall
+            record['cpu_s'] = time.process_time() - cpu
+            end_children = os.times()
+            record['cpu_children_s'] = (end_children.children_user - children.children_user
+                                        + end_children.children_system - children.children_system)
+            if self.trace_memory:
+                record['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            if tracing:
+                tracemalloc.stop()
+            record.update(info)
+            self.stages.append(record)
+            for hook in self.hooks:
+                hook('end', record)
+
+    def report(self):
+        """Отчет о запуске: стадии и итоги в JSON-совместимом виде"""
+        return {
+            'started_at': self.started_at,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'total_wall_s': time.perf_counter() - self._start,
+            'stages': self.stages,
+        }
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2, default=str)
+
+
+def stage(profiler, name, **counts):
+    """profiler.stage(name) или пустой контекст, если замеры выключены (profiler=None)"""
+    if profiler is None:
+        return contextlib.nullcontext(counts)
+    return profiler.stage(name, **counts)
+
+
+def print_stage(event, record):
+    """Хук RunProfiler: строка со временем стадии в stderr"""
+    if event == 'end':
+        print(f"[{record['name']}] {record['wall_s']:.3f} s wall, {record['cpu_s']:.3f} s CPU"
+              + (f", peak {record['peak_mb']:.1f} MB" if 'peak_mb' in record else ''), file=sys.stderr)
+
+
 # === Step 1: Load and Prepare Data ===
-print(f"Loading data from: {FILE_PATH}")
-try:
-    df_full = pd.read_excel(FILE_PATH, sheet_name=SHEET_NAME)
-    print("Excel file loaded successfully.")
-except FileNotFoundError:
-    print(f"ERROR: File not found at {FILE_PATH}")
-    exit()
-except Exception as e:
-    print(f"ERROR: Could not read Excel file. Details: {e}")
-    exit()
-
-# Проверка наличия колонки 'Year'
-if 'Year' not in df_full.columns:
-    print("ERROR: 'Year' column not found in the Excel sheet.")
-    exit()
-
-# Фильтрация по годам
-df = df_full[(df_full['Year'] >= START_YEAR) & (df_full['Year'] <= END_YEAR)].copy()
-required_years = set(range(START_YEAR, END_YEAR + 1))
-available_years = set(df['Year'])
-if not required_years.issubset(available_years):
-    missing_years = required_years - available_years
-    print(f"WARNING: Missing data for years: {sorted(list(missing_years))}. Calculations might be incomplete.")
-
-df.set_index('Year', inplace=True)
-df.sort_index(inplace=True)
-print(f"Data filtered for years {START_YEAR} to {END_YEAR}. Shape: {df.shape}")
+EXCEL_SUFFIXES = ('.xlsx', '.xlsm', '.xls')
+CSV_SUFFIXES = ('.csv',)
+PARQUET_SUFFIXES = ('.parquet', '.pq')
+ARROW_SUFFIXES = ('.feather', '.arrow')
+
+
+def sidecar_path(file_path, sheet_name=SHEET_NAME):
+    """Путь к колоночной копии (Arrow/Feather) листа Excel рядом с исходным файлом"""
+    return f"{file_path}.{sheet_name}.feather"
+
+
+def _arrow_columns(file_path, parquet):
+    if parquet:
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(file_path).schema_arrow.names
+    import pyarrow as pa
+    with pa.memory_map(file_path) as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def read_table(file_path, sheet_name=SHEET_NAME, columns=None, dtype=None):
+    """Читает Excel, CSV, Parquet или Arrow/Feather, только колонки columns (если заданы).
+
+    Колонки, которых нет в файле, просто отсутствуют в результате - проверка делается выше.
+    dtype (словарь колонка -> тип) передается парсеру CSV. Parquet и Arrow/Feather требуют pyarrow.
+    """
+    suffix = os.path.splitext(file_path)[1].lower()
+    wanted = None if columns is None else set(columns)
+    usecols = None if wanted is None else (lambda col: col in wanted)
+
+    if suffix in CSV_SUFFIXES:
+        return pd.read_csv(file_path, usecols=usecols, dtype=dtype)
+    if suffix in PARQUET_SUFFIXES or suffix in ARROW_SUFFIXES:
+        parquet = suffix in PARQUET_SUFFIXES
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(file_path)
+        selected = None if wanted is None else [col for col in _arrow_columns(file_path, parquet) if col in wanted]
+        if parquet:
+            return pd.read_parquet(file_path, columns=selected)
+        return pd.read_feather(file_path, columns=selected)
+    return pd.read_excel(file_path, sheet_name=sheet_name, usecols=usecols)
+
+
+def _compact_dtypes(df, entity_column, value_cols, float_dtype):
+    """Компактные типы: целые годы минимальной ширины, объект - category, значения - float_dtype"""
+    df['Year'] = pd.to_numeric(df['Year'], downcast='integer')
+    if entity_column:
+        df[entity_column] = df[entity_column].astype('category')
+    value_cols = [col for col in value_cols if col in df.columns]
+    df[value_cols] = df[value_cols].astype(float_dtype)
+    return df
+
+
+def load_data(file_path, sheet_name=SHEET_NAME, start_year=START_YEAR, end_year=END_YEAR,
+              entity_column=None, required_cols=None, float_dtype='float64',
+              use_sidecar=True, write_sidecar=False):
+    """Читает входной файл, фильтрует годы и проверяет наличие нужных колонок.
+
+    Поддерживаются Excel, CSV, Parquet и Arrow/Feather; читаются только колонки
+    Year, entity_column и required_cols. Для Excel используется колоночная копия
+    sidecar_path(), если она новее исходного файла и содержит нужные колонки в float64;
+    write_sidecar=True сохраняет такую копию (всегда float64) после разбора Excel.
+
+    Возвращает DataFrame с индексом Year (или (объект, Year) в панельном режиме).
+    Ошибки передаются исключениями: FileNotFoundError, ValueError.
+    """
+    if required_cols is None:
+        required_cols = list(col_mapping.values()) + other_required_cols
+    columns = ['Year'] + ([entity_column] if entity_column else []) + list(required_cols)
+
+    df_full = None
+    is_excel = os.path.splitext(file_path)[1].lower() in EXCEL_SUFFIXES
+    sidecar = sidecar_path(file_path, sheet_name)
+    if is_excel and use_sidecar and os.path.exists(sidecar) and os.path.exists(file_path) \
+            and os.path.getmtime(sidecar) >= os.path.getmtime(file_path):
+        df_full = read_table(sidecar, columns=columns)
+        if not set(columns).issubset(df_full.columns) or \
+                any(df_full[col].dtype != np.float64 for col in required_cols):
+            df_full = None  # В копии нет нужных колонок или они округлены - читаем Excel заново
+    from_excel = df_full is None and is_excel
+    if df_full is None:
+        df_full = read_table(file_path, sheet_name, columns=columns,
+                             dtype={col: float_dtype for col in required_cols})
+
+    df = prepare_frame(df_full, start_year, end_year, entity_column, required_cols, float_dtype,
+                       source=f"sheet '{sheet_name}'")
+    if from_excel and write_sidecar:
+        # Копия хранит исходную точность: float_dtype применяется при каждом чтении
+        _compact_dtypes(df_full, entity_column, required_cols, 'float64').to_feather(sidecar)
+    return df
+
+
+def prepare_frame(df_full, start_year=START_YEAR, end_year=END_YEAR, entity_column=None,
+                  required_cols=None, float_dtype='float64', source='the input table'):
+    """Проверяет колонки, приводит типы, фильтрует годы и индексирует уже прочитанную таблицу"""
+    if required_cols is None:
+        required_cols = list(col_mapping.values()) + other_required_cols
+
+    # Проверка наличия колонки 'Year'
+    if 'Year' not in df_full.columns:
+        raise ValueError(f"'Year' column not found in {source}.")
+    if entity_column and entity_column not in df_full.columns:
+        raise ValueError(f"Entity column '{entity_column}' not found in {source}.")
+    df_full = _compact_dtypes(df_full.copy(), entity_column, required_cols, float_dtype)
+
+    # Фильтрация по годам
+    df = df_full[(df_full['Year'] >= start_year) & (df_full['Year'] <= end_year)].copy()
+    df.set_index([entity_column, 'Year'] if entity_column else 'Year', inplace=True)
+    df.sort_index(inplace=True)
+
+    # Проверка наличия всех необходимых колонок
+    missing_cols = [col for col in required_cols if col not in df.columns]
+    if missing_cols:
+        raise ValueError(f"The following required columns are missing from {source}: {missing_cols}")
+
+    return df
+
+
+def missing_years(df, start_year=START_YEAR, end_year=END_YEAR):
+    """Годы диапазона, для которых нет данных"""
+    available_years = set(df.index.get_level_values('Year'))
+    return sorted(set(range(start_year, end_year + 1)) - available_years)
+
+
+# === Step 1b: Concurrent Loading of Many Workbooks and Sheets ===
+SOURCE_COLUMN = 'Source'
+ALL_SHEETS = '*'
+
+
+def expand_inputs(patterns):
+    """Файлы по шаблонам glob (пути без шаблона - как есть), без повторов, по порядку"""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+
+def _load_input(job):
+    """Читает один файл (все листы sheets) в воркере; возвращает (путь, DataFrame или None, ошибка)"""
+    path, sheets, kwargs = job
+    try:
+        if os.path.splitext(path)[1].lower() not in EXCEL_SUFFIXES:
+            sheets = [SHEET_NAME]
+        elif ALL_SHEETS in sheets:
+            with pd.ExcelFile(path) as workbook:
+                sheets = workbook.sheet_names
+        frames = [load_data(path, sheet, **kwargs) for sheet in sheets]
+        df = pd.concat(frames) if len(frames) > 1 else frames[0]
+        duplicated = df.index[df.index.duplicated()].unique()
+        if len(duplicated):
+            raise ValueError(f"Sheets {sheets} overlap on {list(duplicated[:10])}")
+        return path, df, None
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+def load_many(patterns, sheets=(SHEET_NAME,), start_year=START_YEAR, end_year=END_YEAR,
+              entity_column=None, processes=None, **load_kwargs):
+    """Параллельная загрузка многих файлов и листов в одну панель.
+
+    patterns - пути или шаблоны glob; sheets - листы каждой книги ('*' - все листы,
+    например блоки лет). Каждый файл разбирается и проверяется load_data в пуле
+    процессов (processes=1 - в текущем процессе). Листы одной книги объединяются.
+    Без entity_column объектом считается файл: индекс (SOURCE_COLUMN, Year) с именем
+    файла без расширения. Возвращает (df, ошибки {путь: сообщение}); ошибки одних
+    файлов не мешают загрузке остальных. Файлы, листы которых (или разные файлы
+    в панельном режиме) повторяют одни и те же строки (объект, Year), - ошибки.
+    """
+    paths = expand_inputs(patterns)
+    if not paths:
+        raise FileNotFoundError(', '.join(patterns))
+    kwargs = dict(load_kwargs, start_year=start_year, end_year=end_year, entity_column=entity_column)
+    jobs = [(path, list(sheets), kwargs) for path in paths]
+    if processes is None:
+        processes = min(len(jobs), os.cpu_count() or 1)
+    if processes <= 1:
+        results = [_load_input(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_load_input, jobs))
+
+    errors = {path: error for path, _, error in results if error is not None}
+    loaded = [(path, df) for path, df, error in results if error is None]
+    if not loaded:
+        return None, errors
+    if entity_column:
+        for _, df in loaded:
+            df.index = df.index.set_levels(df.index.levels[0].astype(str), level=0)
+        # Одни и те же (объект, Year) в разных файлах - ошибка обоих файлов
+        keys = pd.concat([df.index.to_frame(index=False).assign(_path=path) for path, df in loaded])
+        key_cols = keys.columns[:-1].tolist()
+        overlap = keys[keys.duplicated(subset=key_cols, keep=False)]
+        for path, rows in overlap.groupby('_path', sort=False):
+            others = sorted(set(overlap.merge(rows[key_cols], on=key_cols)['_path']) - {path})
+            errors[path] = (f"Rows {list(rows.iloc[:10, :-1].itertuples(index=False, name=None))} "
+                            f"also appear in {others}")
+        loaded = [(path, df) for path, df in loaded if path not in errors]
+        if not loaded:
+            return None, errors
+        merged = pd.concat([df for _, df in loaded])
+    else:
+        stems = [os.path.splitext(os.path.basename(path))[0] for path, _ in loaded]
+        # Одинаковые имена файлов из разных папок различаются полным путем
+        labels = [stem if stems.count(stem) == 1 else path for stem, (path, _) in zip(stems, loaded)]
+        merged = pd.concat([df for _, df in loaded], keys=labels, names=[SOURCE_COLUMN])
+    return merged.sort_index(), errors
+
 
 # === Step 2: Define Energy Content and Emission Coefficients ===
 # === ИЗМЕНЕНИЯ: Удалена Crude_Oil, Heat = 0 для избежания двойного счета ===
@@ -77,49 +354,459 @@ col_mapping = {
     'Heat': 'Heat_manufacturing_consumption (thousand gigacalories)'
 }
 
-# Проверка наличия всех необходимых колонок
 other_required_cols = ['Production Output (thousand tonne)', 'GVA_manufacturing USD', 'GDP_country (USD)']
-all_needed_cols = list(col_mapping.values()) + other_required_cols
-missing_cols = [col for col in all_needed_cols if col not in df.columns]
 
-if missing_cols:
-    print(f"ERROR: The following required columns are missing from sheet '{SHEET_NAME}': {missing_cols}")
-    exit()
 
-print("All required columns found.")
+# === Step 2b: Fuel Registry File ===
+REGISTRY_COLUMNS = ['Fuel', 'NCV', 'Emission_Factor', 'Multiplier', 'Column']
 
-# === Step 3: Convert Fuel Consumption to GJ and Emissions ===
-lmdi_data = {}
-for fuel in energy_content.keys():
-    col = col_mapping[fuel]
-    cons = df[col].fillna(0)
 
-    # Определение множителя для перевода в базовые единицы
-    multiplier = 1e3  # Для thousand tonnes/Gcal
+def load_fuel_registry(path):
+    """Читает реестр топлив из CSV или JSON (список записей) с колонками REGISTRY_COLUMNS.
+
+    NCV - ГДж на базовую единицу, Emission_Factor - kg CO2/GJ, Multiplier - перевод
+    единиц входной колонки в базовые, Column - колонка потребления во входном файле.
+    Возвращает словарь {'ncv', 'ef', 'mapping', 'multipliers'} для convert_units,
+    load_converted и stream_aggregate (передается как **registry).
+    """
+    if os.path.splitext(path)[1].lower() == '.json':
+        with open(path, encoding='utf-8') as f:
+            registry = pd.DataFrame.from_records(json.load(f))
+    else:
+        registry = pd.read_csv(path)
+
+    missing_cols = [col for col in REGISTRY_COLUMNS if col not in registry.columns]
+    if missing_cols:
+        raise ValueError(f"The following columns are missing from the fuel registry {path}: {missing_cols}")
+    duplicated = registry['Fuel'][registry['Fuel'].duplicated()].tolist()
+    if duplicated:
+        raise ValueError(f"Duplicate fuels in the fuel registry {path}: {duplicated}")
+
+    fuels = registry['Fuel'].astype(str).tolist()
+    return {
+        'ncv': dict(zip(fuels, registry['NCV'].astype(float))),
+        'ef': dict(zip(fuels, registry['Emission_Factor'].astype(float))),
+        'mapping': dict(zip(fuels, registry['Column'].astype(str))),
+        'multipliers': dict(zip(fuels, registry['Multiplier'].astype(float))),
+    }
+
+
+# === Step 3: Convert Fuel Consumption to GJ and Emissions ===
+def unit_multiplier(fuel, multipliers=None):
+    """Множитель для перевода в базовые единицы (из реестра multipliers, если топливо в нем есть)"""
+    if multipliers is not None and fuel in multipliers:
+        return multipliers[fuel]
     if fuel in ['Gas', 'Electricity']:
-        multiplier = 1e6  # Для mln m3/kWh
+        return 1e6  # Для mln m3/kWh
+    return 1e3  # Для thousand tonnes/Gcal
+
+
+def convert_units(df, ncv=None, ef=None, mapping=None, multipliers=None):
+    """Переводит потребление топлив в ГДж и тонны CO2 и собирает lmdi_df (Steps 3-4).
+
+    ncv, ef, mapping по умолчанию - energy_content, emission_coeff и col_mapping;
+    multipliers - множители единиц из реестра (по умолчанию unit_multiplier).
+    Все топлива пересчитываются одной матричной операцией.
+    """
+    ncv = energy_content if ncv is None else ncv
+    ef = emission_coeff if ef is None else ef
+    mapping = col_mapping if mapping is None else mapping
+    fuels = list(ncv.keys())
+
+    cons = df[[mapping[fuel] for fuel in fuels]].fillna(0).to_numpy()
+    dtype = cons.dtype if cons.dtype.kind == 'f' else np.dtype(float)
+    cons = cons.astype(dtype, copy=False)
 
     # Конвертация в ГДж
-    gj = cons * multiplier * energy_content[fuel]
+    gj = cons * np.array([unit_multiplier(fuel, multipliers) for fuel in fuels], dtype=dtype) \
+        * np.array([ncv[fuel] for fuel in fuels], dtype=dtype)
     # Вычисление выбросов
-    ef_value = emission_coeff[fuel]
-    emissions = gj * ef_value / 1000  # Тонны CO2
+    emissions = gj * np.array([ef[fuel] for fuel in fuels], dtype=dtype) / 1000  # Тонны CO2
+
+    lmdi_data = {}
+    for j, fuel in enumerate(fuels):
+        lmdi_data[f'{fuel}_GJ'] = gj[:, j]
+        lmdi_data[f'{fuel}_Emissions'] = emissions[:, j]
+
+    return add_activity_and_totals(pd.DataFrame(lmdi_data, index=df.index), df, fuels)
 
-    lmdi_data[f'{fuel}_GJ'] = gj
-    lmdi_data[f'{fuel}_Emissions'] = emissions
 
 # === Step 4: Aggregate and Prepare DataFrame ===
-lmdi_df = pd.DataFrame(lmdi_data, index=df.index)
-lmdi_df['GVA_manu'] = df['GVA_manufacturing USD'].fillna(0)
-lmdi_df['GDP'] = df['GDP_country (USD)'].fillna(0)
-lmdi_df['Output'] = df['Production Output (thousand tonne)'].fillna(0)
+def add_activity_and_totals(lmdi_df, df, fuels):
+    """Добавляет к колонкам *_GJ/*_Emissions показатели GVA, GDP, выпуска из df и итоги"""
+    lmdi_df['GVA_manu'] = df['GVA_manufacturing USD'].fillna(0)
+    lmdi_df['GDP'] = df['GDP_country (USD)'].fillna(0)
+    lmdi_df['Output'] = df['Production Output (thousand tonne)'].fillna(0)
+
+    # Суммарная энергия и выбросы
+    fuel_cols_gj = [f'{fuel}_GJ' for fuel in fuels]
+    fuel_cols_emissions = [f'{fuel}_Emissions' for fuel in fuels]
+
+    lmdi_df['Total_Energy'] = lmdi_df[fuel_cols_gj].sum(axis=1)
+    lmdi_df['Total_Emissions'] = lmdi_df[fuel_cols_emissions].sum(axis=1)
+    return lmdi_df
 
-# Суммарная энергия и выбросы
-fuel_cols_gj = [f'{fuel}_GJ' for fuel in energy_content.keys()]
-fuel_cols_emissions = [f'{fuel}_Emissions' for fuel in energy_content.keys()]
 
-lmdi_df['Total_Energy'] = lmdi_df[fuel_cols_gj].sum(axis=1)
-lmdi_df['Total_Emissions'] = lmdi_df[fuel_cols_emissions].sum(axis=1)
+def fuels_of(lmdi_df):
+    """Список топлив lmdi_df в порядке колонок *_GJ"""
+    return [col[:-len('_GJ')] for col in lmdi_df.columns if col.endswith('_GJ')]
+
+
+def active_fuels(lmdi_df, fuels=None):
+    """Топлива с ненулевым потреблением хотя бы в одной строке lmdi_df.
+
+    Остальные не влияют ни на итоги, ни на эффекты, поэтому разложение считается
+    только по активным топливам: затраты растут с их числом, а не с размером реестра.
+    Это объединение по всем строкам; в панели decompose_panel дополнительно берет
+    у каждого объекта только его топлива (panel_arrays(compact=True)).
+    """
+    fuels = fuels_of(lmdi_df) if fuels is None else fuels
+    gj = lmdi_df[[f'{fuel}_GJ' for fuel in fuels]].to_numpy()
+    active = (gj != 0).any(axis=0)
+    return [fuel for fuel, is_active in zip(fuels, active) if is_active]
+
+
+# === Step 4c: Streaming Aggregation of High-Frequency Records ===
+STREAM_CHUNKSIZE = 1_000_000
+
+
+def iter_record_chunks(file_path, columns, chunksize=STREAM_CHUNKSIZE):
+    """Блоки записей CSV или Parquet (только колонки columns) по chunksize строк"""
+    wanted = set(columns)
+    if os.path.splitext(file_path)[1].lower() in PARQUET_SUFFIXES:
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(file_path)
+        present = [col for col in parquet_file.schema_arrow.names if col in wanted]
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=present):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(file_path, usecols=lambda col: col in wanted, chunksize=chunksize)
+
+
+def stream_aggregate(file_path, activity_df, entity_column=None, date_column='Year',
+                     start_year=START_YEAR, end_year=END_YEAR, chunksize=STREAM_CHUNKSIZE,
+                     ncv=None, ef=None, mapping=None, multipliers=None):
+    """Потоковая агрегация записей потребления (по месяцам, часам) в lmdi_df.
+
+    Записи читаются блоками; к каждому блоку применяется пересчет Step 3
+    (множитель единиц и energy_content, emission_coeff), после чего суммы
+    накапливаются по (объект, год). Память зависит от числа объектов и лет,
+    а не от числа записей. date_column - колонка года или даты записи.
+    activity_df - годовые показатели (other_required_cols) с тем же индексом
+    (объект, Year) или Year, как у результата load_data.
+    """
+    ncv = energy_content if ncv is None else ncv
+    ef = emission_coeff if ef is None else ef
+    mapping = col_mapping if mapping is None else mapping
+    fuels = list(ncv.keys())
+    fuel_cols = [mapping[fuel] for fuel in fuels]
+    gj_factor = np.array([unit_multiplier(fuel, multipliers) * ncv[fuel] for fuel in fuels])
+    emissions_factor = gj_factor * np.array([ef[fuel] for fuel in fuels]) / 1000  # Тонны CO2
+    out_cols = [f'{fuel}_GJ' for fuel in fuels] + [f'{fuel}_Emissions' for fuel in fuels]
+    keys = ([entity_column] if entity_column else []) + ['Year']
+
+    totals = None
+    record_cols = fuel_cols + [date_column] + ([entity_column] if entity_column else [])
+    for chunk in iter_record_chunks(file_path, record_cols, chunksize):
+        missing_cols = [col for col in record_cols if col not in chunk.columns]
+        if missing_cols:
+            raise ValueError(f"The following required columns are missing from {file_path}: {missing_cols}")
+
+        if date_column == 'Year':
+            year = chunk['Year'].to_numpy()
+        else:
+            year = pd.to_datetime(chunk[date_column]).dt.year.to_numpy()
+        in_range = (year >= start_year) & (year <= end_year)
+
+        cons = chunk[fuel_cols].fillna(0).to_numpy(dtype=float)[in_range]
+        frame = pd.DataFrame(np.hstack([cons * gj_factor, cons * emissions_factor]), columns=out_cols)
+        frame['Year'] = year[in_range]
+        if entity_column:
+            frame[entity_column] = chunk[entity_column].to_numpy()[in_range]
+        sums = frame.groupby(keys, sort=False).sum()
+        totals = sums if totals is None else totals.add(sums, fill_value=0)
+
+    if totals is None:
+        totals = pd.DataFrame(columns=out_cols, index=activity_df.index[:0], dtype=float)
+    index = totals.index.union(activity_df.index)
+    fuel_order = [col for fuel in fuels for col in (f'{fuel}_GJ', f'{fuel}_Emissions')]
+    lmdi_df = totals.reindex(index, fill_value=0.0)[fuel_order].sort_index()
+    return add_activity_and_totals(lmdi_df, activity_df.reindex(lmdi_df.index), fuels)
+
+
+# === Step 4b: On-Disk Cache of Converted Data ===
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'lmdi')
+CACHE_MAX_BYTES = 512 * 1024 ** 2
+CACHE_VERSION = 2  # Увеличить при изменении логики пересчета единиц
+
+
+def file_digest(file_path, chunk_size=1 << 20):
+    """Хэш содержимого файла (BLAKE2b)"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def coefficients_digest(ncv=None, ef=None, mapping=None, required_cols=None, multipliers=None):
+    """Хэш таблиц energy_content, emission_coeff, col_mapping, множителей и обязательных колонок"""
+    ncv = energy_content if ncv is None else ncv
+    payload = {
+        'ncv': ncv,
+        'ef': emission_coeff if ef is None else ef,
+        'mapping': col_mapping if mapping is None else mapping,
+        'multipliers': {fuel: unit_multiplier(fuel, multipliers) for fuel in ncv},
+        'required': other_required_cols if required_cols is None else list(required_cols),
+    }
+    encoded = json.dumps(payload, sort_keys=True).encode('utf-8')
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def _evict_cache(cache_dir, max_bytes, keep=None):
+    """Удаляет самые давно использованные записи, пока кэш больше max_bytes"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pkl'):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        os.remove(path)
+        total -= size
+
+
+def load_converted(file_path, sheet_name=SHEET_NAME, start_year=START_YEAR, end_year=END_YEAR,
+                   entity_column=None, float_dtype='float64', ncv=None, ef=None, mapping=None,
+                   multipliers=None, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, profiler=None,
+                   **load_kwargs):
+    """load_data + convert_units с постоянным кэшем готового lmdi_df.
+
+    Ключ - хэш содержимого файла, лист, диапазон лет, колонка объекта, тип значений
+    и хэш таблиц коэффициентов. При попадании ни разбор файла, ни пересчет единиц
+    не выполняются. cache_dir=None отключает кэш. Возвращает (lmdi_df, из_кэша).
+    profiler (RunProfiler) получает стадии cache_read, read, convert и cache_write.
+    """
+    if mapping is not None and 'required_cols' not in load_kwargs:
+        load_kwargs['required_cols'] = list(mapping.values()) + other_required_cols
+    key = None
+    if cache_dir is not None:
+        parts = [CACHE_VERSION, file_digest(file_path), sheet_name, start_year, end_year,
+                 entity_column, float_dtype, coefficients_digest(ncv, ef, mapping, multipliers=multipliers)]
+        key = hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16).hexdigest()
+        cache_path = os.path.join(cache_dir, f'{key}.pkl')
+        if os.path.exists(cache_path):
+            os.utime(cache_path)  # Отметка использования для вытеснения
+            with stage(profiler, 'cache_read') as info:
+                lmdi_df = pd.read_pickle(cache_path)
+                info['rows'] = len(lmdi_df)
+            return lmdi_df, True
+
+    with stage(profiler, 'read') as info:
+        df = load_data(file_path, sheet_name, start_year, end_year, entity_column=entity_column,
+                       float_dtype=float_dtype, **load_kwargs)
+        info['rows'] = len(df)
+    with stage(profiler, 'convert') as info:
+        lmdi_df = convert_units(df, ncv, ef, mapping, multipliers)
+        info.update(rows=len(lmdi_df), fuels=len(fuels_of(lmdi_df)))
+
+    if key is not None:
+        with stage(profiler, 'cache_write'):
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            lmdi_df.to_pickle(tmp_path)
+            os.replace(tmp_path, cache_path)
+            _evict_cache(cache_dir, max_bytes, keep=cache_path)
+    return lmdi_df, False
+
+
+# === Step 4d: Memory-Mapped Array Store for Large Panels ===
+# Массивы (объекты, годы, топлива) и (объекты, годы) вместо колонок lmdi_df; годы выровнены влево
+STORE_FUEL_ARRAYS = ('gj', 'emissions')
+STORE_YEAR_ARRAYS = ('total_gj', 'total_emissions', 'output', 'gva')
+STORE_META = 'store.json'
+_OPEN_STORES = {}
+
+
+def create_store(path, entities, n_slots, fuels, float_dtype='float64', entity_name=None):
+    """Пустое хранилище в папке path: по файлу .npy на массив, подписи в store.json.
+
+    entities - все объекты (порядок строк), n_slots - наибольшее число лет объекта.
+    Возвращает хранилище, открытое на запись (см. open_store); заполняется store_block.
+    """
+    os.makedirs(path, exist_ok=True)
+    entities = pd.Index(entities, name=entity_name)
+    shapes = {name: (len(entities), n_slots, len(fuels)) for name in STORE_FUEL_ARRAYS}
+    shapes.update({name: (len(entities), n_slots) for name in STORE_YEAR_ARRAYS})
+    for name, shape in shapes.items():
+        np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype=float_dtype, shape=shape)
+    np.lib.format.open_memmap(os.path.join(path, 'years.npy'), mode='w+', dtype='int32',
+                              shape=(len(entities), n_slots))
+    np.lib.format.open_memmap(os.path.join(path, 'counts.npy'), mode='w+', dtype='int32', shape=(len(entities),))
+    meta = {'entity_name': entity_name, 'entities': entities.tolist(), 'fuels': list(fuels),
+            'dtype': np.dtype(float_dtype).name}
+    with open(os.path.join(path, STORE_META), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    return open_store(path, mode='r+')
+
+
+def open_store(path, mode='r'):
+    """Открывает хранилище без чтения в память: словарь memmap-массивов и подписей.
+
+    Ключи совпадают с panel_arrays (entities, years, counts, gj, emissions, output, gva),
+    поэтому срез store[name][lo:hi] передается в decompose_panel_arrays как есть.
+    mode='r' - только чтение: одно хранилище могут разделять несколько процессов.
+    """
+    with open(os.path.join(path, STORE_META), encoding='utf-8') as f:
+        meta = json.load(f)
+    store = {'path': path, 'fuels': meta['fuels'],
+             'entities': pd.Index(meta['entities'], name=meta['entity_name'])}
+    for name in STORE_FUEL_ARRAYS + STORE_YEAR_ARRAYS + ('years', 'counts'):
+        store[name] = np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mode)
+    return store
+
+
+def store_block(store, lmdi_df):
+    """Записывает объекты lmdi_df (индекс (объект, Year)) в их строки хранилища"""
+    panel = panel_arrays(lmdi_df, store['fuels'])
+    rows = store['entities'].get_indexer(panel['entities'])
+    if (rows < 0).any():
+        raise ValueError(f"Entities not in the store: {list(panel['entities'][rows < 0][:5])}")
+    n_slots = panel['years'].shape[1]
+    if n_slots > store['years'].shape[1]:
+        raise ValueError(f"Entities have {n_slots} years, the store holds {store['years'].shape[1]}.")
+
+    store['gj'][rows, :n_slots] = panel['gj']
+    store['emissions'][rows, :n_slots] = panel['emissions']
+    store['total_gj'][rows, :n_slots] = panel['gj'].sum(axis=-1)
+    store['total_emissions'][rows, :n_slots] = panel['emissions'].sum(axis=-1)
+    store['output'][rows, :n_slots] = panel['output']
+    store['gva'][rows, :n_slots] = panel['gva']
+    store['years'][rows, :n_slots] = panel['years']
+    store['counts'][rows] = panel['counts']
+
+
+def build_store(lmdi_df, path, fuels=None, float_dtype='float64', block_entities=10000):
+    """Хранилище из панели lmdi_df (по умолчанию только активные топлива); объекты пишутся
+    блоками по block_entities. Возвращает хранилище, открытое только на чтение."""
+    fuels = active_fuels(lmdi_df) if fuels is None else fuels
+    entity_codes, entities = pd.factorize(lmdi_df.index.get_level_values(0), sort=True)
+    n_slots = int(np.bincount(entity_codes).max()) if len(entity_codes) else 0
+    store = create_store(path, entities, n_slots, fuels, float_dtype, lmdi_df.index.names[0])
+    for start in range(0, len(entities), block_entities):
+        store_block(store, lmdi_df[(entity_codes >= start) & (entity_codes < start + block_entities)])
+    for name in STORE_FUEL_ARRAYS + STORE_YEAR_ARRAYS + ('years', 'counts'):
+        store[name].flush()
+    return open_store(path)
+
+
+def stream_store(file_path, path, entity_column, start_year=START_YEAR, end_year=END_YEAR,
+                 sheet_name=SHEET_NAME, chunksize=STREAM_CHUNKSIZE, float_dtype='float64',
+                 ncv=None, ef=None, mapping=None, multipliers=None):
+    """Хранилище прямо из входного файла, без lmdi_df всей панели в памяти.
+
+    CSV и Parquet читаются блоками по chunksize строк в два прохода: первый - только
+    объект, Year и потребление (ячейки объектов и активные топлива), второй пересчитывает
+    каждый блок (Steps 3-4) и пишет его строки в их ячейки. Excel и Arrow читаются целиком.
+    Возвращает хранилище, открытое только на чтение.
+    """
+    ncv = energy_content if ncv is None else ncv
+    mapping = col_mapping if mapping is None else mapping
+    fuel_cols = [mapping[fuel] for fuel in ncv]
+    required_cols = fuel_cols + other_required_cols
+    streamed = os.path.splitext(file_path)[1].lower() in CSV_SUFFIXES + PARQUET_SUFFIXES
+
+    def frames(value_cols):
+        chunks = iter_record_chunks(file_path, [entity_column, 'Year'] + value_cols, chunksize) if streamed \
+            else [read_table(file_path, sheet_name, columns=[entity_column, 'Year'] + value_cols)]
+        for chunk in chunks:
+            yield prepare_frame(chunk, start_year, end_year, entity_column, value_cols, float_dtype,
+                                source=file_path)
+
+    # Проход 1: ячейки (объект, год) и топлива с ненулевым потреблением
+    keys, active = [], np.zeros(len(fuel_cols), dtype=bool)
+    for frame in frames(fuel_cols):
+        keys.append(frame.index.to_frame(index=False))
+        active |= (frame[fuel_cols].fillna(0).to_numpy() != 0).any(axis=0)
+    keys = pd.concat(keys, ignore_index=True).sort_values([entity_column, 'Year'], ignore_index=True)
+    index = pd.MultiIndex.from_frame(keys)
+    if index.duplicated().any():
+        raise ValueError("Duplicate (entity, Year) rows in panel data.")
+    entity_codes, entities = pd.factorize(keys[entity_column], sort=True)
+    slot = keys.groupby(entity_column, sort=False).cumcount().to_numpy()
+    counts = np.bincount(entity_codes, minlength=len(entities))
+    fuels = [fuel for fuel, is_active in zip(ncv, active) if is_active]
+
+    store = create_store(path, entities, int(counts.max()) if len(counts) else 0, fuels, float_dtype,
+                         entity_column)
+    store['years'][entity_codes, slot] = keys['Year'].to_numpy()
+    store['counts'][:] = counts
+
+    # Проход 2: пересчет блока и запись его строк в их ячейки
+    for frame in frames(required_cols):
+        lmdi_df = convert_units(frame, ncv, ef, mapping, multipliers)
+        position = index.get_indexer(lmdi_df.index)
+        rows, slots = entity_codes[position], slot[position]
+        gj = lmdi_df[[f'{fuel}_GJ' for fuel in fuels]].to_numpy()
+        emissions = lmdi_df[[f'{fuel}_Emissions' for fuel in fuels]].to_numpy()
+        store['gj'][rows, slots] = gj
+        store['emissions'][rows, slots] = emissions
+        store['total_gj'][rows, slots] = gj.sum(axis=-1)
+        store['total_emissions'][rows, slots] = emissions.sum(axis=-1)
+        store['output'][rows, slots] = lmdi_df['Output'].to_numpy()
+        store['gva'][rows, slots] = lmdi_df['GVA_manu'].to_numpy()
+    for name in STORE_FUEL_ARRAYS + STORE_YEAR_ARRAYS + ('years', 'counts'):
+        store[name].flush()
+    return open_store(path)
+
+
+def store_slice(store, lo, hi):
+    """Массивы объектов lo:hi хранилища - представления memmap, без копирования"""
+    panel = {name: store[name][lo:hi] for name in STORE_FUEL_ARRAYS + STORE_YEAR_ARRAYS + ('years', 'counts')}
+    panel['entities'] = store['entities'][lo:hi]
+    return panel
+
+
+def _decompose_store_block(job):
+    """Блок объектов хранилища в воркере; хранилище открывается один раз на процесс"""
+    path, lo, hi, kwargs = job
+    if path not in _OPEN_STORES:
+        _OPEN_STORES[path] = open_store(path)
+    store = _OPEN_STORES[path]
+    return decompose_panel_arrays(store_slice(store, lo, hi), entity_name=store['entities'].name, **kwargs)
+
+
+def decompose_store(store, start_year=START_YEAR, end_year=END_YEAR, block_size=1000, processes=None,
+                    epsilon=EPSILON, multiplicative=False):
+    """decompose_panel по хранилищу: объекты блоками по block_size, блоки - в пуле процессов.
+
+    store - путь или результат open_store. Воркеры открывают одно и то же хранилище
+    только на чтение и считают по срезам memmap; в память попадает лишь текущий блок.
+    processes=1 - в текущем процессе. Результат тот же, что у decompose_panel.
+    """
+    store = open_store(store) if isinstance(store, str) else store
+    kwargs = {'start_year': start_year, 'end_year': end_year, 'epsilon': epsilon, 'multiplicative': multiplicative}
+    n_entities = len(store['entities'])
+    jobs = [(store['path'], lo, min(lo + block_size, n_entities), kwargs) for lo in range(0, n_entities, block_size)]
+    if not jobs:
+        return decompose_panel_arrays(store_slice(store, 0, 0), entity_name=store['entities'].name, **kwargs)
+    if processes is None:
+        processes = min(len(jobs), os.cpu_count() or 1)
+    if processes <= 1:
+        blocks = [decompose_panel_arrays(store_slice(store, lo, hi), entity_name=store['entities'].name, **kw)
+                  for _, lo, hi, kw in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=tracemalloc.stop) as executor:
+            blocks = list(executor.map(_decompose_store_block, jobs))
+    if multiplicative:
+        return pd.concat([block[0] for block in blocks]), pd.concat([block[1] for block in blocks])
+    return pd.concat(blocks)
+
 
 # === Step 5: Log Mean Function ===
 def log_mean(x, y, epsilon=EPSILON):
@@ -138,106 +825,1169 @@ def log_mean(x, y, epsilon=EPSILON):
     if y == 0:
         return -x / (np.log(epsilon) - np.log(x_adj))
 
-    return (y - x) / (np.log(y) - np.log(x))
+    log_diff = np.log(y) - np.log(x)
+    if log_diff == 0:
+        return (x + y) / 2  # Значения различаются меньше точности логарифма
+    return (y - x) / log_diff
+
+
+def log_mean_array(x, y, epsilon=EPSILON):
+    """Векторизованное логарифмическое среднее (те же ветви epsilon и нулей, что в log_mean)"""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x_adj = np.where(x >= 0, np.maximum(x, epsilon), x)
+    y_adj = np.where(y >= 0, np.maximum(y, epsilon), y)
+    log_eps = np.log(epsilon)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_diff = np.log(y) - np.log(x)
+        # Значения, различающиеся меньше точности логарифма, - как равные
+        general = np.where(log_diff != 0, (y - x) / log_diff, (x + y) / 2)
+        from_zero = y / (np.log(y_adj) - log_eps)
+        to_zero = -x / (log_eps - np.log(x_adj))
+
+    result = np.where(x == 0, from_zero, np.where(y == 0, to_zero, general))
+    return np.where(np.abs(x - y) < epsilon, (x + y) / 2, result)
+
+
+EFFECT_COLUMNS = ['Production', 'Economic_Effect (GVA/Output)', 'Intensity (Energy/GVA)',
+                  'Mix (Fuel Share)', 'Emission_Factor (CO2/Energy)']
+RESULT_COLUMNS = ['Total_Change'] + EFFECT_COLUMNS + ['Sum_of_Effects', 'Difference']
+# Мультипликативная форма: E1/E0 = произведение факторов эффектов (Residual_Ratio = 1 при точном разложении)
+MULTIPLICATIVE_COLUMNS = ['Total_Ratio'] + EFFECT_COLUMNS + ['Product_of_Effects', 'Residual_Ratio']
+
+
+def _safe_log(v, epsilon=EPSILON):
+    return np.log(np.maximum(v, epsilon))
+
+
+def activity_terms(gj, output, gva, epsilon=EPSILON):
+    """Погодовые логарифмы выпуска, GVA/выпуск, энергии/GVA и долей топлив.
+
+    gj: массив (..., годы, топлива); output, gva: (..., годы).
+    Зависят только от энергии и экономических показателей, не от коэффициентов выбросов.
+    """
+    gj = np.asarray(gj, dtype=float)
+    output = np.asarray(output, dtype=float)
+    gva = np.asarray(gva, dtype=float)
+
+    total_energy = gj.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vs = np.where(output != 0, gva / output, 0.0)
+        ei = np.where(gva != 0, total_energy / gva, 0.0)
+        share = np.where(total_energy[..., None] > epsilon, gj / total_energy[..., None], 0.0)
+
+    return {
+        'log_y': _safe_log(output, epsilon),
+        'log_vs': _safe_log(vs, epsilon),
+        'log_ei': _safe_log(ei, epsilon),
+        'log_s': _safe_log(share, epsilon),
+    }
+
+
+def emission_terms(gj, emissions, epsilon=EPSILON):
+    """Погодовые выбросы, коэффициенты выбросов (CO2/GJ), их логарифмы и маска ненулевых выбросов"""
+    gj = np.asarray(gj, dtype=float)
+    emissions = np.asarray(emissions, dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ef = np.where(gj > epsilon, emissions / gj, 0.0)
+
+    return {
+        'emissions': emissions,
+        'total_emissions': emissions.sum(axis=-1),
+        'ef': ef,
+        'log_ef': _safe_log(ef, epsilon),
+        'present': np.abs(emissions) >= epsilon,
+    }
+
+
+def yearly_terms(gj, emissions, output, gva, epsilon=EPSILON):
+    """Все погодовые величины LMDI; считаются один раз для любого набора периодов"""
+    terms = activity_terms(gj, output, gva, epsilon)
+    terms.update(emission_terms(gj, emissions, epsilon))
+    terms['epsilon'] = epsilon
+    return terms
+
+
+def _pick(a, idx, fuel_axis=False):
+    """Выбор годов idx по оси лет; idx (периоды,) общий или (..., периоды) свой для каждого ряда"""
+    axis = -2 if fuel_axis else -1
+    if idx.ndim == 1:
+        return np.take(a, idx, axis=axis)
+    return np.take_along_axis(a, idx[..., None] if fuel_axis else idx, axis=axis)
+
+
+def period_pairs(n_years, kind='chained', base=0):
+    """Индексы (idx0, idx1) периодов.
+
+    kind: 'chained' - последовательные годы, 'fixed' - от базового года base
+    ко всем последующим, 'all' - все пары year0 < year1 (верхний треугольник).
+    """
+    if kind == 'chained':
+        idx0 = np.arange(max(n_years - 1, 0))
+        return idx0, idx0 + 1
+    if kind == 'fixed':
+        idx1 = np.arange(base + 1, n_years)
+        return np.full_like(idx1, base), idx1
+    if kind == 'all':
+        return np.triu_indices(n_years, 1)
+    raise ValueError(f"Unknown period kind '{kind}'. Use 'chained', 'fixed' or 'all'.")
+
+
+def period_weights(terms, idx0, idx1):
+    """Веса L(C^0, C^1) выбросов каждого топлива для периодов (idx0, idx1): (..., периоды, топлива)"""
+    emissions = terms['emissions']
+    ci0, ci1 = _pick(emissions, idx0, True), _pick(emissions, idx1, True)
+    L_ci = log_mean_array(ci0, ci1, terms['epsilon'])
+    # Топлива, отсутствующие в обоих годах, не дают вклада (маска посчитана заранее в emission_terms)
+    present = _pick(terms['present'], idx0, True) | _pick(terms['present'], idx1, True)
+    return np.where(present, L_ci, 0.0)
+
+
+def decompose_terms(terms, idx0=None, idx1=None, per_fuel=False, multiplicative=False):
+    """LMDI-разложение для периодов (idx0[i], idx1[i]) по заранее посчитанным yearly_terms.
+
+    Возвращает массив (..., периоды, len(RESULT_COLUMNS)) в порядке RESULT_COLUMNS.
+    Из того же прохода можно получить дополнительно (в этом порядке, кортежем после values):
+    per_fuel=True - вклады топлив (..., периоды, топлива, len(EFFECT_COLUMNS));
+    multiplicative=True - мультипликативные факторы (..., периоды, len(MULTIPLICATIVE_COLUMNS)).
+    """
+    values, fuel_values, mult_values = _decompose(terms, idx0, idx1, per_fuel, multiplicative)
+    extras = ([fuel_values] if per_fuel else []) + ([mult_values] if multiplicative else [])
+    return (values, *extras) if extras else values
+
+
+def _decompose(terms, idx0, idx1, per_fuel=False, multiplicative=False):
+    """decompose_terms: всегда (values, fuel_values или None, mult_values или None)"""
+    epsilon = terms['epsilon']
+    if idx0 is None or idx1 is None:
+        idx0, idx1 = period_pairs(terms['log_y'].shape[-1])
+    idx0, idx1 = np.asarray(idx0), np.asarray(idx1)
+
+    def ratio(name, fuel_axis=False):
+        return _pick(terms[name], idx1, fuel_axis) - _pick(terms[name], idx0, fuel_axis)
+
+    L_ci = period_weights(terms, idx0, idx1)
+    L_sum = L_ci.sum(axis=-1)
+
+    ef0, ef1 = _pick(terms['ef'], idx0, True), _pick(terms['ef'], idx1, True)
+    log_ef_ratio = np.where(np.abs(ef0 - ef1) < epsilon, 0.0, ratio('log_ef', True))
+
+    total_change = ratio('total_emissions')
+    fuel_values = None
+    if per_fuel:
+        fuel_values = np.stack([
+            L_ci * ratio('log_y')[..., None],
+            L_ci * ratio('log_vs')[..., None],
+            L_ci * ratio('log_ei')[..., None],
+            L_ci * ratio('log_s', True),
+            L_ci * log_ef_ratio,
+        ], axis=-1)
+    effects = np.stack([
+        L_sum * ratio('log_y'),
+        L_sum * ratio('log_vs'),
+        L_sum * ratio('log_ei'),
+        (L_ci * ratio('log_s', True)).sum(axis=-1),
+        (L_ci * log_ef_ratio).sum(axis=-1),
+    ], axis=-1)
+    sum_of_effects = effects.sum(axis=-1)
+
+    values = np.concatenate([
+        total_change[..., None],
+        effects,
+        sum_of_effects[..., None],
+        (total_change - sum_of_effects)[..., None],
+    ], axis=-1)
+
+    mult_values = None
+    if multiplicative:
+        # LMDI-I: ln D_k = ΔC_k / L(C^0, C^1) - те же логарифмы и веса, что и в аддитивной форме
+        c0, c1 = _pick(terms['total_emissions'], idx0), _pick(terms['total_emissions'], idx1)
+        L_total = log_mean_array(c0, c1, epsilon)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_factors = np.where(L_total[..., None] > 0, effects / L_total[..., None], 0.0)
+            total_ratio = np.where(np.abs(c0) >= epsilon, c1 / c0, np.nan)
+        factors = np.exp(log_factors)
+        product = np.exp(log_factors.sum(axis=-1))
+        mult_values = np.concatenate([
+            total_ratio[..., None],
+            factors,
+            product[..., None],
+            (total_ratio / product)[..., None],
+        ], axis=-1)
+    return values, fuel_values, mult_values
+
+
+def decompose_arrays(gj, emissions, output, gva, idx0=None, idx1=None, epsilon=EPSILON):
+    """LMDI-разложение для всех периодов сразу.
+
+    gj, emissions: массивы (..., годы, топлива); output, gva: (..., годы).
+    idx0, idx1: индексы базового и конечного года для каждого периода
+    (по умолчанию - последовательные годы).
+    Возвращает массив (..., периоды, len(RESULT_COLUMNS)) в порядке RESULT_COLUMNS.
+    """
+    return decompose_terms(yearly_terms(gj, emissions, output, gva, epsilon), idx0, idx1)
+
+
+def panel_arrays(lmdi_df, fuels=None, compact=False):
+    """Плотные массивы (объекты, годы, топлива) из lmdi_df с индексом (объект, Year).
+
+    Годы каждого объекта выравниваются влево: k-й доступный год объекта лежит
+    в ячейке k, поэтому последовательные периоды - это соседние ячейки.
+    compact=True - у каждого объекта свои топлива: ось топлив длиной с наибольшее
+    число активных топлив одного объекта, 'fuel_index' (объекты, ячейки) - позиции
+    в 'fuels' (len(fuels) - пустая ячейка с нулями). Тогда размер массивов и расчета
+    растет с числом топлив объекта, а не с объединением топлив всей панели.
+    """
+    if lmdi_df.index.duplicated().any():
+        raise ValueError("Duplicate (entity, Year) rows in panel data.")
+    fuels = active_fuels(lmdi_df) if fuels is None else fuels
+
+    frame = lmdi_df.sort_index()
+    entity_codes, entities = pd.factorize(frame.index.get_level_values(0), sort=True)
+    slot = frame.groupby(level=0, sort=False, observed=True).cumcount().to_numpy()
+    n_entities, n_slots = len(entities), int(slot.max()) + 1 if len(slot) else 0
+
+    def dense(values):
+        arr = np.zeros((n_entities, n_slots) + values.shape[1:], dtype=float)
+        arr[entity_codes, slot] = values
+        return arr
+
+    year_values = frame.index.get_level_values(-1).to_numpy()
+    years = np.zeros((n_entities, n_slots), dtype=year_values.dtype)
+    years[entity_codes, slot] = year_values
+
+    gj = frame[[f'{fuel}_GJ' for fuel in fuels]].to_numpy(dtype=float)
+    emissions = frame[[f'{fuel}_Emissions' for fuel in fuels]].to_numpy(dtype=float)
+    arrays = {}
+    if compact:
+        active = pd.DataFrame(gj != 0).groupby(entity_codes).any().to_numpy()
+        width = int(active.sum(axis=1).max()) if len(active) else 0
+        order = np.argsort(~active, axis=1, kind='stable')[:, :width]
+        fuel_index = np.where(np.take_along_axis(active, order, axis=1), order, len(fuels))
+        row_index = fuel_index[entity_codes]
+        gj, emissions = (np.take_along_axis(np.pad(values, ((0, 0), (0, 1))), row_index, axis=1)
+                         for values in (gj, emissions))
+        arrays = {'fuels': list(fuels), 'fuel_index': fuel_index}
+
+    arrays.update({
+        'entities': entities,
+        'years': years,
+        'counts': np.bincount(entity_codes, minlength=n_entities),
+        'gj': dense(gj),
+        'emissions': dense(emissions),
+        'output': dense(frame['Output'].to_numpy(dtype=float)),
+        'gva': dense(frame['GVA_manu'].to_numpy(dtype=float)),
+    })
+    return arrays
+
+
+def decompose_panel(lmdi_df, start_year=START_YEAR, end_year=END_YEAR, fuels=None, epsilon=EPSILON,
+                    per_fuel=False, multiplicative=False):
+    """Годовые и общий (start_year-end_year) периоды для всех объектов за один проход.
+
+    Возвращает длинную таблицу с индексом (объект, Period) и колонками RESULT_COLUMNS.
+    Дополнительно (кортежем после results_df, в этом порядке): per_fuel=True - вклады
+    топлив (строки таблицы, топлива, эффекты); multiplicative=True - таблица с тем же
+    индексом и колонками MULTIPLICATIVE_COLUMNS.
+    """
+    return decompose_panel_arrays(panel_arrays(lmdi_df, fuels, compact=True), start_year, end_year,
+                                  lmdi_df.index.names[0], epsilon, per_fuel, multiplicative)
+
+
+def decompose_panel_arrays(panel, start_year=START_YEAR, end_year=END_YEAR, entity_name=None, epsilon=EPSILON,
+                           per_fuel=False, multiplicative=False):
+    """decompose_panel по готовым массивам panel_arrays или срезу хранилища open_store (без копирования).
+
+    Вклады топлив при panel['fuel_index'] раскладываются обратно по оси panel['fuels'].
+    """
+    entities, years, counts = panel['entities'], panel['years'], panel['counts']
+    frames, fuel_blocks, mult_frames, codes = [], [], [], []
+
+    terms = yearly_terms(panel['gj'], panel['emissions'], panel['output'], panel['gva'], epsilon)
+
+    # Последовательные периоды: ячейки k и k+1 внутри каждого объекта
+    if years.shape[1] > 1:
+        values, fuel_values, mult_values = _decompose(terms, *period_pairs(years.shape[1]), per_fuel,
+                                                      multiplicative)
+        e_idx, k_idx = np.nonzero(np.arange(years.shape[1] - 1)[None, :] < (counts[:, None] - 1))
+        frames.append(_panel_frame(entity_name, entities[e_idx], years[e_idx, k_idx],
+                                   years[e_idx, k_idx + 1], values[e_idx, k_idx]))
+        codes.append(e_idx)
+        if per_fuel:
+            fuel_blocks.append(fuel_values[e_idx, k_idx])
+        if multiplicative:
+            mult_frames.append(_panel_frame(entity_name, entities[e_idx], years[e_idx, k_idx],
+                                            years[e_idx, k_idx + 1], mult_values[e_idx, k_idx],
+                                            MULTIPLICATIVE_COLUMNS))
+
+    # Общий период: первая и последняя ячейки объекта, если это start_year и end_year
+    last = counts - 1
+    rows = np.arange(len(entities))
+    has_overall = (years[:, 0] == start_year) & (years[rows, last] == end_year) & (counts > 2)
+    if start_year != end_year and has_overall.any():
+        sel = rows[has_overall]
+        idx0, idx1 = np.zeros_like(last)[:, None], last[:, None]
+        values, fuel_values, mult_values = _decompose(terms, idx0, idx1, per_fuel, multiplicative)
+        frames.append(_panel_frame(entity_name, entities[sel], years[sel, 0],
+                                   years[sel, last[sel]], values[sel, 0]))
+        codes.append(sel)
+        if per_fuel:
+            fuel_blocks.append(fuel_values[sel, 0])
+        if multiplicative:
+            mult_frames.append(_panel_frame(entity_name, entities[sel], years[sel, 0],
+                                            years[sel, last[sel]], mult_values[sel, 0], MULTIPLICATIVE_COLUMNS))
+
+    extras = []
+    if not frames:
+        index = pd.MultiIndex.from_arrays([[], []], names=[entity_name, 'Period'])
+        results_df = pd.DataFrame(columns=RESULT_COLUMNS, index=index)
+        if per_fuel:
+            n_fuels = len(panel['fuels']) if 'fuel_index' in panel else panel['gj'].shape[-1]
+            extras.append(np.zeros((0, n_fuels, len(EFFECT_COLUMNS))))
+        if multiplicative:
+            extras.append(pd.DataFrame(columns=MULTIPLICATIVE_COLUMNS, index=index))
+        return (results_df, *extras) if extras else results_df
+    # Объекты уже отсортированы (factorize sort=True): порядок строк - устойчивая сортировка по коду
+    order = np.argsort(np.concatenate(codes), kind='stable')
+    results_df = pd.concat(frames).iloc[order]
+    if per_fuel:
+        fuel_values = np.concatenate(fuel_blocks)[order]
+        if 'fuel_index' in panel:
+            # Ячейки топлив объекта - на их места в общем списке; пустые ячейки - в отбрасываемую колонку
+            index = panel['fuel_index'][np.concatenate(codes)[order]]
+            spread = np.zeros((len(fuel_values), len(panel['fuels']) + 1, len(EFFECT_COLUMNS)))
+            spread[np.arange(len(fuel_values))[:, None], index] = fuel_values
+            fuel_values = spread[:, :-1]
+        extras.append(fuel_values)
+    if multiplicative:
+        extras.append(pd.concat(mult_frames).iloc[order])
+    return (results_df, *extras) if extras else results_df
+
+
+def _panel_frame(entity_name, entities, year0, year1, values, columns=RESULT_COLUMNS):
+    period = pd.Series(year0).astype(str) + '-' + pd.Series(year1).astype(str)
+    index = pd.MultiIndex.from_arrays([entities, period], names=[entity_name, 'Period'])
+    return pd.DataFrame(values, index=index, columns=columns)
 
-# === Step 6: LMDI Additive Decomposition ===
-all_results = []
-years = sorted(list(lmdi_df.index))
-print("\nCalculating LMDI Decomposition for each period...")
 
-for i in range(len(years) - 1):
-    year0, year1 = years[i], years[i+1]
-    period = f"{year0}-{year1}"
-    print(f"  Processing period: {period}")
+# === Step 6: LMDI Additive Decomposition ===
+def series_arrays(lmdi_df, fuels=None):
+    """Массивы (годы, топлива) и (годы,) одиночного ряда lmdi_df для decompose_arrays"""
+    fuels = active_fuels(lmdi_df) if fuels is None else fuels
+    years = sorted(list(lmdi_df.index))
+    return {
+        'years': years,
+        'gj': lmdi_df.loc[years, [f'{fuel}_GJ' for fuel in fuels]].to_numpy(dtype=float),
+        'emissions': lmdi_df.loc[years, [f'{fuel}_Emissions' for fuel in fuels]].to_numpy(dtype=float),
+        'output': lmdi_df.loc[years, 'Output'].to_numpy(dtype=float),
+        'gva': lmdi_df.loc[years, 'GVA_manu'].to_numpy(dtype=float),
+    }
+
+
+def series_terms(lmdi_df, fuels=None, epsilon=EPSILON):
+    """yearly_terms одиночного ряда lmdi_df вместе со списком лет ('years')"""
+    arrays = series_arrays(lmdi_df, fuels)
+    terms = yearly_terms(arrays['gj'], arrays['emissions'], arrays['output'], arrays['gva'], epsilon)
+    terms['years'] = arrays['years']
+    return terms
+
+
+def resolve_pairs(years, pairs='chained', base_year=None):
+    """Индексы (idx0, idx1) и подписи периодов для decompose_periods"""
+    if isinstance(pairs, str):
+        base = years.index(base_year) if base_year is not None else 0
+        idx0, idx1 = period_pairs(len(years), pairs, base)
+    else:
+        position = {year: i for i, year in enumerate(years)}
+        missing = sorted({year for pair in pairs for year in pair if year not in position})
+        if missing:
+            raise ValueError(f"No data for years: {missing}")
+        idx0 = np.array([position[year0] for year0, _ in pairs], dtype=int)
+        idx1 = np.array([position[year1] for _, year1 in pairs], dtype=int)
+    periods = [f"{years[i]}-{years[j]}" for i, j in zip(idx0, idx1)]
+    return idx0, idx1, periods
+
+
+def decompose_periods(terms, pairs='chained', base_year=None, per_fuel=False, multiplicative=False):
+    """Разложение для набора периодов по одной предварительной выборке series_terms.
+
+    pairs: 'chained', 'fixed' (от base_year, по умолчанию первый год), 'all'
+    (все пары year0 < year1) или список пар (year0, year1).
+    Возвращает DataFrame с индексом Period и колонками RESULT_COLUMNS; дополнительно
+    (кортежем, в этом порядке): per_fuel=True - вклады топлив (периоды, топлива, эффекты),
+    multiplicative=True - DataFrame с колонками MULTIPLICATIVE_COLUMNS.
+    """
+    idx0, idx1, periods = resolve_pairs(terms['years'], pairs, base_year)
+    values, fuel_values, mult_values = _decompose(terms, idx0, idx1, per_fuel, multiplicative)
+    index = pd.Index(periods, name='Period')
+    results_df = pd.DataFrame(values.reshape(len(periods), len(RESULT_COLUMNS)),
+                              index=index, columns=RESULT_COLUMNS)
+    extras = [fuel_values] if per_fuel else []
+    if multiplicative:
+        extras.append(pd.DataFrame(mult_values.reshape(len(periods), len(MULTIPLICATIVE_COLUMNS)),
+                                   index=index, columns=MULTIPLICATIVE_COLUMNS))
+    return (results_df, *extras) if extras else results_df
+
+
+def overall_results(terms, start_year=START_YEAR, end_year=END_YEAR):
+    """Словарь результатов за период start_year-end_year или None, если годов нет"""
+    years = terms['years']
+    if start_year not in years or end_year not in years or start_year == end_year:
+        return None
+
+    overall_values = decompose_periods(terms, [(start_year, end_year)]).iloc[0]
+    results_overall = {'Period': f"{start_year}-{end_year}"}
+    results_overall.update(zip(RESULT_COLUMNS, overall_values.tolist()))
+    return results_overall
+
+
+def decompose_yearly(lmdi_df, fuels=None, epsilon=EPSILON):
+    """Разложение по последовательным годам; DataFrame с индексом Period"""
+    return decompose_periods(series_terms(lmdi_df, fuels, epsilon), 'chained')
+
+
+def decompose_overall(lmdi_df, start_year=START_YEAR, end_year=END_YEAR, fuels=None, epsilon=EPSILON):
+    """Разложение за весь период start_year-end_year; словарь результатов или None, если годов нет"""
+    return overall_results(series_terms(lmdi_df, fuels, epsilon), start_year, end_year)
+
+
+# === Step 6d: Hierarchical Decomposition (Sector -> Subsector -> Entity) ===
+HIERARCHY_COLUMNS = (['Total_Change', 'Production', 'Structure'] + EFFECT_COLUMNS[1:]
+                     + ['Entry_Exit', 'Sum_of_Effects', 'Difference'])
+ROOT_NODE = 'Total'
+
+
+def load_hierarchy(path, sheet_name=SHEET_NAME):
+    """Дерево объектов: колонки уровней сверху вниз (например Sector, Subsector, Plant), последняя - объекты"""
+    tree = read_table(path, sheet_name).dropna(how='all').astype(str)
+    if tree.shape[1] < 2:
+        raise ValueError(f"The hierarchy {path} needs at least two level columns.")
+    leaf_level = tree.columns[-1]
+    conflicts = tree.groupby(leaf_level)[list(tree.columns[:-1])].nunique().gt(1).any(axis=1)
+    if conflicts.any():
+        raise ValueError(f"Entities with more than one parent in {path}: {conflicts[conflicts].index.tolist()}")
+    return tree.drop_duplicates(subset=leaf_level)
+
+
+def _group_sum(values, codes, n_groups):
+    """Суммы строк values по группам codes: (n_groups, ...)"""
+    out = np.zeros((n_groups,) + values.shape[1:])
+    np.add.at(out, codes, values)
+    return out
+
+
+def hierarchy_arrays(lmdi_df, tree, start_year=START_YEAR, end_year=END_YEAR, fuels=None):
+    """Данные объектов для периодов разложения и их суммы по уровням дерева.
+
+    lmdi_df - панель с индексом (объект, Year); tree - см. load_hierarchy. Периоды -
+    последовательные годы общей сетки и общий период start_year-end_year. В период
+    входят только объекты с данными за оба его года; выбросы появившихся и выбывших
+    объектов (в том числе пропуск года) учитываются отдельно в 'entry'. Массивы
+    (узлы, периоды, 2, ...) - начало и конец периода; суммы уровня - из сумм уровня ниже.
+    Возвращает (периоды, уровни снизу вверх): у уровня 'level', 'nodes' (пути через ' / '),
+    'arrays' (gj, emissions, output, gva), 'entry' (узлы, периоды) и 'parent' - коды
+    узлов следующего уровня.
+    """
+    fuels = active_fuels(lmdi_df) if fuels is None else fuels
+    tree = tree.set_index(tree.columns[-1])
+    entity_values = lmdi_df.index.get_level_values(0).astype(str)
+    missing = sorted(set(entity_values) - set(tree.index))
+    if missing:
+        raise ValueError(f"Entities missing from the hierarchy: {missing}")
+
+    year_values = lmdi_df.index.get_level_values(-1).to_numpy()
+    years = list(np.unique(year_values))
+    entity_codes, entities = pd.factorize(entity_values, sort=True)
+    year_codes = np.searchsorted(years, year_values)
+    pairs = list(zip(years[:-1], years[1:]))
+    if start_year in years and end_year in years and years.index(end_year) - years.index(start_year) > 1:
+        pairs.append((start_year, end_year))
+    idx0, idx1, periods = resolve_pairs(years, pairs)
+
+    present = np.zeros((len(entities), len(years)), dtype=bool)
+    present[entity_codes, year_codes] = True
+    both = present[:, idx0] & present[:, idx1]
+
+    def paired(values):
+        arr = np.zeros((len(entities), len(years)) + values.shape[1:])
+        arr[entity_codes, year_codes] = values
+        # Начало и конец каждого периода; объекты без одного из годов в период не входят
+        arr = np.stack([arr[:, idx0], arr[:, idx1]], axis=2)
+        return arr * both.reshape(both.shape + (1,) * (arr.ndim - 2))
+
+    emissions = lmdi_df[[f'{fuel}_Emissions' for fuel in fuels]].to_numpy(dtype=float)
+    arrays = {
+        'gj': paired(lmdi_df[[f'{fuel}_GJ' for fuel in fuels]].to_numpy(dtype=float)),
+        'emissions': paired(emissions),
+        'output': paired(lmdi_df['Output'].to_numpy(dtype=float)),
+        'gva': paired(lmdi_df['GVA_manu'].to_numpy(dtype=float)),
+    }
+    total = np.zeros((len(entities), len(years)))
+    total[entity_codes, year_codes] = emissions.sum(axis=1)
+    entry = np.where(both, 0.0, total[:, idx1] - total[:, idx0])
+
+    # Путь от корня для каждого объекта
+    paths = [tuple(row) + (entity,) for entity, row in zip(entities, tree.loc[entities].itertuples(index=False))]
+    level_names = [ROOT_NODE] + list(tree.columns) + [tree.index.name]
+    levels = []
+    for depth in range(len(level_names) - 1, 0, -1):
+        parent_paths = [path[:depth - 1] for path in paths]
+        codes, parents = pd.factorize(pd.Index([' / '.join(path) for path in parent_paths]))
+        levels.append({'level': level_names[depth], 'nodes': [' / '.join(path) for path in paths],
+                       'arrays': arrays, 'entry': entry, 'parent': codes})
+        # Суммы родителей - из сумм детей
+        arrays = {name: _group_sum(values, codes, len(parents)) for name, values in arrays.items()}
+        entry = _group_sum(entry, codes, len(parents))
+        first = np.unique(codes, return_index=True)[1]
+        paths = [parent_paths[i] for i in first]
+    levels.append({'level': ROOT_NODE, 'nodes': [ROOT_NODE], 'arrays': arrays, 'entry': entry, 'parent': None})
+    return periods, levels
+
+
+def decompose_hierarchy(lmdi_df, tree, start_year=START_YEAR, end_year=END_YEAR, fuels=None,
+                        epsilon=EPSILON):
+    """Разложение на всех уровнях дерева с эффектом структуры (доли выпуска дочерних узлов).
+
+    Разлагаются только объекты (листья); строка узла собирается из строк его детей:
+    все эффекты, кроме Production, - суммы эффектов детей (включая их Structure), а
+    вклад выпуска детей делится на Production - по выпуску узла с весом суммы весов
+    L его объектов - и добавку к Structure (смена долей детей в выпуске узла). Поэтому
+    на каждом уровне сумма строк детей равна строке родителя (Production + Structure -
+    в сумме). Для листьев Structure = 0. Объекты без данных за один из годов периода
+    в разложение периода не входят: их выбросы на концах периода попадают в Entry_Exit
+    (появление +E1, выбытие -E0), поэтому Total_Change - полное изменение выбросов узла,
+    а Difference остается ~0. Возвращает DataFrame с индексом (Level, Node, Period)
+    и колонками HIERARCHY_COLUMNS.
+    """
+    periods, levels = hierarchy_arrays(lmdi_df, tree, start_year, end_year, fuels)
+    production, structure = HIERARCHY_COLUMNS.index('Production'), HIERARCHY_COLUMNS.index('Structure')
+    # Ось "лет" каждого периода - его начало и конец
+    idx0, idx1 = np.array([0]), np.array([1])
+
+    child = levels[0]
+    terms = yearly_terms(**child['arrays'], epsilon=epsilon)
+    values = decompose_terms(terms, idx0, idx1)[..., 0, :]
+    weights = period_weights(terms, idx0, idx1).sum(axis=-1)[..., 0]
+    entry = child['entry'][..., None]
+    rows = np.concatenate([values[..., :1] + entry, values[..., 1:2], np.zeros_like(entry), values[..., 2:6],
+                           entry, values[..., 6:7] + entry, values[..., 7:]], axis=-1)
+    frames = [(child, rows)]
+    for parent in levels[1:]:
+        codes, n_parents = child['parent'], len(parent['nodes'])
+        output = parent['arrays']['output']
+        d_log_y = _safe_log(output[..., 1], epsilon) - _safe_log(output[..., 0], epsilon)
+
+        weights = _group_sum(weights, codes, n_parents)
+        rows = _group_sum(rows, codes, n_parents)
+        own = weights * d_log_y
+        rows[..., structure] += rows[..., production] - own
+        rows[..., production] = own
+        frames.append((parent, rows))
+        child = parent
+
+    results = []
+    for level, values in reversed(frames):
+        index = pd.MultiIndex.from_product([[level['level']], level['nodes'], periods],
+                                           names=['Level', 'Node', 'Period'])
+        results.append(pd.DataFrame(values.reshape(-1, len(HIERARCHY_COLUMNS)), index=index,
+                                    columns=HIERARCHY_COLUMNS))
+    return pd.concat(results)
+
+
+def hierarchy_gaps(hierarchy_df):
+    """Расхождение суммы строк детей со строкой родителя: max |.| по колонкам для каждого уровня родителей.
+
+    Production и Structure сравниваются в сумме (их раздел зависит от уровня).
+    """
+    values = hierarchy_df.drop(columns=['Production', 'Structure'])
+    values.insert(1, 'Production+Structure', hierarchy_df['Production'] + hierarchy_df['Structure'])
+    levels = list(hierarchy_df.index.unique(level='Level'))
+    gaps = {}
+    for parent_level, child_level in zip(levels[:-1], levels[1:]):
+        children = values.xs(child_level, level='Level')
+        nodes = children.index.get_level_values('Node')
+        parents = nodes.str.rsplit(' / ', n=1).str[0] if parent_level != ROOT_NODE else \
+            pd.Index([ROOT_NODE] * len(nodes))
+        summed = children.groupby([parents, children.index.get_level_values('Period')]).sum()
+        summed.index.names = ['Node', 'Period']
+        gaps[parent_level] = (summed - values.xs(parent_level, level='Level')).abs().max()
+    return pd.DataFrame(gaps).T
+
+
+# === Step 6b: Monte Carlo Uncertainty of NCVs and Emission Coefficients ===
+MC_COLUMNS = ['Total_Change'] + EFFECT_COLUMNS
+MC_PERCENTILES = (2.5, 50.0, 97.5)
+MC_DISTRIBUTIONS = {'normal': 1, 'lognormal': 1, 'uniform': 2, 'triangular': 2}  # Число параметров
+
+
+def load_mc_spec(path, fuels=None):
+    """Читает и проверяет JSON {'ncv': {топливо: [распределение, ...]}, 'ef': {...}}.
+
+    fuels - допустимые топлива (например fuels_of(lmdi_df)); ошибки - ValueError.
+    """
+    with open(path, encoding='utf-8') as f:
+        spec = json.load(f)
+    if not isinstance(spec, dict) or set(spec) - {'ncv', 'ef'}:
+        raise ValueError(f"{path} must be an object with 'ncv' and/or 'ef' keys.")
+    for kind, dists in spec.items():
+        if not isinstance(dists, dict):
+            raise ValueError(f"'{kind}' in {path} must map fuels to distributions.")
+        for fuel, dist in dists.items():
+            if fuels is not None and fuel not in fuels:
+                raise ValueError(f"Unknown fuel '{fuel}' in '{kind}'. Available: {list(fuels)}")
+            if not isinstance(dist, list) or not dist or dist[0] not in MC_DISTRIBUTIONS:
+                raise ValueError(f"Invalid distribution for {kind}:{fuel}: {dist}. "
+                                 f"Use one of {list(MC_DISTRIBUTIONS)}.")
+            if len(dist) - 1 != MC_DISTRIBUTIONS[dist[0]] or \
+                    not all(isinstance(v, (int, float)) for v in dist[1:]):
+                raise ValueError(f"'{dist[0]}' for {kind}:{fuel} needs {MC_DISTRIBUTIONS[dist[0]]} "
+                                 f"numeric parameter(s), got {dist[1:]}.")
+            if len(dist) == 3 and dist[1] > dist[2]:
+                raise ValueError(f"'{dist[0]}' for {kind}:{fuel} has low > high: {dist[1:]}.")
+    return spec
+
+
+def sample_coefficients(point, spec, n_samples, rng):
+    """Выборки коэффициентов (n_samples, топлива) вокруг точечных значений point.
+
+    spec: {топливо: распределение}; топлива без распределения остаются точечными.
+      ('normal', sd)            - нормальное со средним point, отсечено снизу нулем
+      ('lognormal', sigma)      - логнормальное с медианой point (sigma в лог-шкале)
+      ('uniform', low, high)    - равномерное на [low, high]
+      ('triangular', low, high) - треугольное с модой point
+    """
+    point = np.asarray(point, dtype=float)
+    samples = np.broadcast_to(point, (n_samples, len(point))).copy()
+    for j, dist in spec.items():
+        kind, params = dist[0], dist[1:]
+        if kind == 'normal':
+            samples[:, j] = np.maximum(rng.normal(point[j], params[0], n_samples), 0.0)
+        elif kind == 'lognormal':
+            samples[:, j] = point[j] * rng.lognormal(0.0, params[0], n_samples)
+        elif kind == 'uniform':
+            samples[:, j] = rng.uniform(params[0], params[1], n_samples)
+        elif kind == 'triangular':
+            samples[:, j] = rng.triangular(params[0], point[j], params[1], n_samples)
+        else:
+            raise ValueError(f"Unknown distribution '{kind}'.")
+    return samples
+
+
+def monte_carlo(lmdi_df, ncv_spec=None, ef_spec=None, n_samples=10000, chunk_size=1000,
+                pairs='chained', percentiles=MC_PERCENTILES, ncv=None, ef=None, seed=None,
+                epsilon=EPSILON):
+    """Распространение неопределенности NCV и коэффициентов выбросов через разложение.
+
+    ncv_spec, ef_spec: {топливо: распределение} (см. sample_coefficients) для
+    energy_content и emission_coeff. Выборки обрабатываются блоками по chunk_size
+    как один тензор (выборки, годы, топлива), поэтому память ограничена блоком.
+    Возвращает DataFrame с индексом (Period, Effect) и колонками Mean и P<перцентиль>
+    для Total_Change и пяти эффектов.
+    """
+    ncv = energy_content if ncv is None else ncv
+    ef = emission_coeff if ef is None else ef
+    all_fuels = fuels_of(lmdi_df)
+    unknown = sorted(fuel for fuel in {**(ncv_spec or {}), **(ef_spec or {})} if fuel not in all_fuels)
+    if unknown:
+        raise ValueError(f"Unknown fuels in the Monte Carlo spec: {unknown}")
+    # Неиспользуемые топлива не влияют на результат и не разыгрываются
+    fuels = active_fuels(lmdi_df, all_fuels)
+    position = {fuel: j for j, fuel in enumerate(fuels)}
+    ncv_spec = {position[fuel]: dist for fuel, dist in (ncv_spec or {}).items() if fuel in position}
+    ef_spec = {position[fuel]: dist for fuel, dist in (ef_spec or {}).items() if fuel in position}
+
+    arrays = series_arrays(lmdi_df, fuels)
+    idx0, idx1, periods = resolve_pairs(arrays['years'], pairs)
+    ncv_point = np.array([ncv[fuel] for fuel in fuels], dtype=float)
+    ef_point = np.array([ef[fuel] for fuel in fuels], dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        base_units = np.where(ncv_point > 0, arrays['gj'] / ncv_point, 0.0)  # Потребление в базовых единицах
+
+    rng = np.random.default_rng(seed)
+    results = np.empty((n_samples, len(periods), len(MC_COLUMNS)))
+    for start in range(0, n_samples, chunk_size):
+        n = min(chunk_size, n_samples - start)
+        ncv_s = sample_coefficients(ncv_point, ncv_spec, n, rng)
+        ef_s = sample_coefficients(ef_point, ef_spec, n, rng)
+        gj = base_units[None, :, :] * ncv_s[:, None, :]
+        emissions = gj * ef_s[:, None, :] / 1000
+        terms = yearly_terms(gj, emissions, arrays['output'], arrays['gva'], epsilon)
+        results[start:start + n] = decompose_terms(terms, idx0, idx1)[..., :len(MC_COLUMNS)]
+
+    summary = np.concatenate([results.mean(axis=0)[None],
+                              np.percentile(results, percentiles, axis=0)])
+    index = pd.MultiIndex.from_product([periods, MC_COLUMNS], names=['Period', 'Effect'])
+    columns = ['Mean'] + [f'P{p:g}' for p in percentiles]
+    return pd.DataFrame(summary.reshape(len(columns), -1).T, index=index, columns=columns)
+
+
+# === Step 6c: Coefficient Scenarios ===
+def scenario_grid(ncv=None, ef=None):
+    """Все сочетания переопределений коэффициентов.
+
+    ncv, ef: {топливо: [значения, ...]}. Возвращает список сценариев
+    {'name': ..., 'ncv': {топливо: значение}, 'ef': {...}} для run_scenarios.
+    """
+    axes = [('ncv', fuel, values) for fuel, values in (ncv or {}).items()]
+    axes += [('ef', fuel, values) for fuel, values in (ef or {}).items()]
+    scenarios = [{'name': 'base', 'ncv': {}, 'ef': {}}]
+    for kind, fuel, values in axes:
+        scenarios = [{**sc, kind: {**sc[kind], fuel: value},
+                      'name': ('' if sc['name'] == 'base' else sc['name'] + ', ') + f"{kind}:{fuel}={value:g}"}
+                     for sc in scenarios for value in values]
+    return scenarios
+
+
+def run_scenarios(lmdi_df, scenarios, pairs='chained', ncv=None, ef=None, chunk_size=1000,
+                  epsilon=EPSILON):
+    """Разложение для набора сценариев коэффициентов одним пакетным проходом.
+
+    scenarios: список {'name': ..., 'ncv': {топливо: значение}, 'ef': {...}} (см. scenario_grid);
+    неуказанные коэффициенты берутся из ncv/ef (по умолчанию energy_content и emission_coeff).
+    Изменение коэффициентов выбросов не затрагивает *_GJ, доли топлив и интенсивность:
+    activity_terms считаются один раз для каждого различного набора NCV в блоке, а на
+    каждый сценарий пересчитываются только выбросы. Сценарии обрабатываются блоками по
+    chunk_size, поэтому память ограничена блоком и при переборе NCV.
+    Возвращает DataFrame с индексом (Scenario, Period) и колонками RESULT_COLUMNS.
+    """
+    ncv = energy_content if ncv is None else ncv
+    ef = emission_coeff if ef is None else ef
+    if not scenarios:
+        raise ValueError("No scenarios given.")
+    all_fuels = fuels_of(lmdi_df)
+    unknown = sorted({fuel for sc in scenarios for kind in ('ncv', 'ef') for fuel in sc.get(kind, {})
+                      if fuel not in all_fuels})
+    if unknown:
+        raise ValueError(f"Unknown fuels in scenarios: {unknown}")
+    fuels = active_fuels(lmdi_df, all_fuels)
+
+    arrays = series_arrays(lmdi_df, fuels)
+    idx0, idx1, periods = resolve_pairs(arrays['years'], pairs)
+    ncv_point = np.array([ncv[fuel] for fuel in fuels], dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        base_units = np.where(ncv_point > 0, arrays['gj'] / ncv_point, 0.0)  # Потребление в базовых единицах
+
+    ncv_s = np.array([[sc.get('ncv', {}).get(fuel, ncv[fuel]) for fuel in fuels] for sc in scenarios], dtype=float)
+    ef_s = np.array([[sc.get('ef', {}).get(fuel, ef[fuel]) for fuel in fuels] for sc in scenarios], dtype=float)
+
+    # Энергетические величины - один раз на каждый различный набор NCV в блоке
+    ncv_unique, ncv_group = np.unique(ncv_s, axis=0, return_inverse=True)
+    ncv_group = ncv_group.reshape(-1)
+
+    results = np.empty((len(scenarios), len(periods), len(RESULT_COLUMNS)))
+    for start in range(0, len(scenarios), chunk_size):
+        chunk_groups, group = np.unique(ncv_group[start:start + chunk_size], return_inverse=True)
+        gj_unique = base_units[None, :, :] * ncv_unique[chunk_groups][:, None, :]
+        shape = (len(chunk_groups), len(arrays['years']))
+        activity = activity_terms(gj_unique, np.broadcast_to(arrays['output'], shape),
+                                  np.broadcast_to(arrays['gva'], shape), epsilon)
+        if len(chunk_groups) == 1:
+            # Меняются только коэффициенты выбросов: общие activity_terms транслируются на все сценарии блока
+            terms = {name: values[0] for name, values in activity.items()}
+            gj = gj_unique[0]
+        else:
+            terms = {name: values[group.reshape(-1)] for name, values in activity.items()}
+            gj = gj_unique[group.reshape(-1)]
+        emissions = gj * ef_s[start:start + chunk_size, None, :] / 1000
+        terms.update(emission_terms(gj, emissions, epsilon))
+        terms['epsilon'] = epsilon
+        results[start:start + chunk_size] = decompose_terms(terms, idx0, idx1)
+
+    names = [sc.get('name', str(i)) for i, sc in enumerate(scenarios)]
+    index = pd.MultiIndex.from_product([names, periods], names=['Scenario', 'Period'])
+    return pd.DataFrame(results.reshape(-1, len(RESULT_COLUMNS)), index=index, columns=RESULT_COLUMNS)
+
+
+# === Step 6e: Robustness (Leave-One-Year-Out and Bootstrap of Inputs) ===
+ROBUSTNESS_COLUMNS = ['Base', 'Mean', 'Std'] + [f'P{p:g}' for p in MC_PERCENTILES] + ['Min', 'Max']
+_ROBUSTNESS_ARRAYS = {}
+
+
+def robustness_arrays(lmdi_df, start_year=START_YEAR, end_year=END_YEAR, fuels=None):
+    """Массивы (ряды, годы, топлива) для robustness: одиночный ряд или объекты панели.
+
+    В панели остаются объекты с данными за start_year, end_year и хотя бы одним годом
+    между ними (годы выровнены влево, как в panel_arrays); 'names' - их имена или None
+    для одиночного ряда.
+    """
+    if isinstance(lmdi_df.index, pd.MultiIndex):
+        arrays = panel_arrays(lmdi_df, fuels)
+        years, counts = arrays['years'], arrays['counts']
+        rows = np.arange(len(counts))
+        keep = (years[:, 0] == start_year) & (years[rows, counts - 1] == end_year) & (counts > 2)
+        arrays = {name: values[keep] for name, values in arrays.items()}
+        arrays['names'] = arrays.pop('entities')
+        return arrays
+
+    lmdi_df = lmdi_df[(lmdi_df.index >= start_year) & (lmdi_df.index <= end_year)]
+    arrays = series_arrays(lmdi_df, fuels)
+    if start_year not in arrays['years'] or end_year not in arrays['years']:
+        raise ValueError(f"No data for {start_year} or {end_year}.")
+    return {
+        'names': None,
+        'years': np.asarray(arrays['years'])[None, :],
+        'counts': np.array([len(arrays['years'])]),
+        'gj': arrays['gj'][None], 'emissions': arrays['emissions'][None],
+        'output': arrays['output'][None], 'gva': arrays['gva'][None],
+    }
+
+
+def _chained_total(terms, counts):
+    """Цепные годовые эффекты (..., ряды, периоды, MC_COLUMNS) с нулями вне рядов и их сумма"""
+    chained = decompose_terms(terms)[..., :len(MC_COLUMNS)]
+    valid = np.arange(chained.shape[-2]) < (counts[:, None] - 1)
+    chained = np.where(valid[..., None], chained, 0.0)
+    return chained, chained.sum(axis=-2)
+
+
+def _init_robustness(arrays):
+    """Инициализатор воркера: исходные массивы передаются один раз на процесс"""
+    tracemalloc.stop()
+    _ROBUSTNESS_ARRAYS.clear()
+    _ROBUSTNESS_ARRAYS.update(arrays)
+
+
+def _bootstrap_chunk(job):
+    """Блок бутстреп-реплик: (реплики, ряды, MC_COLUMNS) по массивам _ROBUSTNESS_ARRAYS"""
+    seed_seq, n, sigma, epsilon = job
+    arrays = _ROBUSTNESS_ARRAYS
+    rng = np.random.default_rng(seed_seq)
+    # Ошибка измерения потребления: множитель на каждую (год, топливо); коэффициент выбросов не меняется
+    noise = rng.lognormal(0.0, sigma, (n,) + arrays['gj'].shape)
+    terms = yearly_terms(arrays['gj'] * noise, arrays['emissions'] * noise,
+                         arrays['output'], arrays['gva'], epsilon)
+    return _chained_total(terms, arrays['counts'])[1]
+
+
+def _summary(values, base, percentiles):
+    """Base, Mean, Std, перцентили, Min, Max по оси реплик 0 (NaN - пропущенные реплики)"""
+    return np.stack([base, np.nanmean(values, axis=0), np.nanstd(values, axis=0),
+                     *np.nanpercentile(values, percentiles, axis=0),
+                     np.nanmin(values, axis=0), np.nanmax(values, axis=0)], axis=-1)
+
+
+def robustness(lmdi_df, start_year=START_YEAR, end_year=END_YEAR, n_bootstrap=1000, sigma=0.05,
+               chunk_size=1000, processes=None, seed=None, fuels=None, epsilon=EPSILON):
+    """Чувствительность общего разложения start_year-end_year к отдельным годам и ошибкам входа.
+
+    Общий результат здесь - сумма цепных годовых эффектов: только она зависит от
+    промежуточных лет (прямое разложение start_year-end_year видит лишь два года).
+    - leave_one_year_out: реплика без внутреннего года k, периоды (k-1, k) и (k, k+1)
+      заменяются на (k-1, k+1); start_year и end_year не исключаются. Все реплики
+      получаются из одного прохода по цепным периодам и периодам через год.
+    - bootstrap: n_bootstrap реплик, в которых потребление каждого топлива за каждый год
+      умножено на логнормальную ошибку с sigma (лог-шкала). Блоки по chunk_size
+      рядов-реплик считаются в пуле процессов (processes=1 - в текущем процессе);
+      исходные массивы передаются воркеру один раз, результат не зависит от числа процессов.
+    Возвращает DataFrame с индексом ([объект,] Method, Effect) и колонками ROBUSTNESS_COLUMNS;
+    Base - результат по исходным данным.
+    """
+    arrays = robustness_arrays(lmdi_df, start_year, end_year, fuels)
+    names, counts = arrays['names'], arrays['counts']
+    n_series, n_slots = arrays['years'].shape
+    if n_series == 0:
+        raise ValueError(f"No entities with data for both {start_year} and {end_year}.")
+    if n_slots < 3:
+        raise ValueError("Leave-one-year-out needs at least three years.")
+    arrays = {name: arrays[name] for name in ('gj', 'emissions', 'output', 'gva', 'counts')}
+
+    terms = yearly_terms(arrays['gj'], arrays['emissions'], arrays['output'], arrays['gva'], epsilon)
+    chained, base = _chained_total(terms, counts)
+
+    # Leave-one-year-out: сумма без периодов, смежных с годом k, плюс период (k-1, k+1)
+    skip_idx0 = np.arange(n_slots - 2)
+    skip = decompose_terms(terms, skip_idx0, skip_idx0 + 2)[..., :len(MC_COLUMNS)]
+    slots = np.arange(n_slots)
+    before = np.concatenate([np.zeros_like(chained[:, :1]), chained], axis=1)  # период (k-1, k)
+    after = np.concatenate([chained, np.zeros_like(chained[:, :1])], axis=1)  # период (k, k+1)
+    bridge = np.concatenate([np.zeros_like(skip[:, :1]), skip, np.zeros_like(skip[:, :1])], axis=1)
+    inner = (slots > 0) & (slots[None, :] < counts[:, None] - 1)
+    # Только внутренние годы: без start_year или end_year изменился бы сам период
+    loyo = np.where(inner[..., None], base[:, None] - before - after + bridge, np.nan)
+    summaries = [_summary(np.moveaxis(loyo, 1, 0), base, MC_PERCENTILES)]
+    methods = ['leave_one_year_out']
+
+    if n_bootstrap:
+        per_task = max(1, chunk_size // n_series)
+        sizes = [min(per_task, n_bootstrap - start) for start in range(0, n_bootstrap, per_task)]
+        jobs = [(seed_seq, n, sigma, epsilon)
+                for seed_seq, n in zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes)]
+        if processes is None:
+            processes = min(len(jobs), os.cpu_count() or 1)
+        if processes <= 1:
+            _init_robustness(arrays)
+            blocks = [_bootstrap_chunk(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_robustness,
+                                     initargs=(arrays,)) as executor:
+                blocks = list(executor.map(_bootstrap_chunk, jobs))
+        summaries.append(_summary(np.concatenate(blocks), base, MC_PERCENTILES))
+        methods.append('bootstrap')
+
+    # (методы, ряды, эффекты, статистики) -> строки ([объект,] Method, Effect)
+    values = np.stack(summaries, axis=1)
+    columns = ROBUSTNESS_COLUMNS
+    if names is None:
+        index = pd.MultiIndex.from_product([methods, MC_COLUMNS], names=['Method', 'Effect'])
+    else:
+        index = pd.MultiIndex.from_product([names, methods, MC_COLUMNS],
+                                           names=[lmdi_df.index.names[0], 'Method', 'Effect'])
+    return pd.DataFrame(values.reshape(-1, len(columns)), index=index, columns=columns)
+
+
+# === Step 6f: Cross-Sectional Decomposition (Entity vs Entity or Benchmark) ===
+# Те же yearly_terms и decompose_terms, но ось "лет" - это объекты одного года
+BENCHMARK_NAME = 'Benchmark'
+CROSS_BLOCK_PAIRS = 100000
+
+
+def cross_section_terms(lmdi_df, year, entities=None, fuels=None, benchmark=True, epsilon=EPSILON):
+    """yearly_terms объектов панели за год year: логарифмы считаются один раз на объект.
+
+    benchmark=True добавляет последней строкой средний объект BENCHMARK_NAME (средние
+    потребление, выбросы, выпуск и GVA, т.е. отраслевые интенсивности и доли).
+    'entities' - подписи строк.
+    """
+    if year not in lmdi_df.index.get_level_values(-1):
+        raise ValueError(f"No data for {year}.")
+    frame = lmdi_df.xs(year, level=-1)
+    if entities is not None:
+        frame = frame.loc[list(entities)]
+    if frame.empty:
+        raise ValueError(f"No entities with data for {year}.")
+    fuels = active_fuels(frame) if fuels is None else fuels
+    gj = frame[[f'{fuel}_GJ' for fuel in fuels]].to_numpy(dtype=float)
+    emissions = frame[[f'{fuel}_Emissions' for fuel in fuels]].to_numpy(dtype=float)
+    output = frame['Output'].to_numpy(dtype=float)
+    gva = frame['GVA_manu'].to_numpy(dtype=float)
+    names = list(frame.index)
+    if benchmark:
+        gj, emissions = np.vstack([gj, gj.mean(axis=0)]), np.vstack([emissions, emissions.mean(axis=0)])
+        output, gva = np.append(output, output.mean()), np.append(gva, gva.mean())
+        names.append(BENCHMARK_NAME)
+    terms = yearly_terms(gj, emissions, output, gva, epsilon)
+    terms['entities'] = names
+    return terms
+
+
+def _reference_position(names, reference):
+    """Номер строки эталона по имени (сравнение и как строка - для имен из командной строки)"""
+    for i, name in enumerate(names):
+        if name == reference or str(name) == str(reference):
+            return i
+    raise ValueError(f"No data for reference entity '{reference}'.")
+
+
+def decompose_cross_section(lmdi_df, year, reference=BENCHMARK_NAME, entities=None, fuels=None,
+                            epsilon=EPSILON, multiplicative=False):
+    """Разложение разницы выбросов каждого объекта и эталона за один год.
+
+    reference - имя объекта или BENCHMARK_NAME (средний объект). Строка объекта:
+    Total_Change = E(объект) - E(эталон) и вклады эффектов в эту разницу.
+    Возвращает DataFrame с индексом объекта и колонками RESULT_COLUMNS;
+    multiplicative=True - также таблицу MULTIPLICATIVE_COLUMNS (E(объект) / E(эталон)).
+    """
+    terms = cross_section_terms(lmdi_df, year, entities, fuels, reference == BENCHMARK_NAME, epsilon)
+    names = terms['entities']
+    ref = _reference_position(names, reference)
+    rows = np.array([i for i in range(len(names)) if i != ref])
+    values, _, mult_values = _decompose(terms, np.full_like(rows, ref), rows, multiplicative=multiplicative)
+    index = pd.Index([names[i] for i in rows], name=lmdi_df.index.names[0])
+    results_df = pd.DataFrame(values, index=index, columns=RESULT_COLUMNS)
+    if multiplicative:
+        return results_df, pd.DataFrame(mult_values, index=index, columns=MULTIPLICATIVE_COLUMNS)
+    return results_df
+
+
+def cross_section_matrix(lmdi_df, year, entities=None, fuels=None, path=None, block_pairs=CROSS_BLOCK_PAIRS,
+                         epsilon=EPSILON):
+    """Матрица попарных разложений N x N объектов за год year.
+
+    values[i, j] - разложение разницы E(j) - E(i) (i - эталон) в порядке RESULT_COLUMNS;
+    матрица антисимметрична. Пары считаются блоками строк по ~block_pairs пар, поэтому
+    промежуточные массивы ограничены блоком, а не N^2. Сам результат N x N x
+    len(RESULT_COLUMNS) при path=None целиком в памяти; для больших N нужен path -
+    .npy, записываемый через memmap, с подписями в path + '.json' (см. load_cross_matrix).
+    Возвращает (values, имена).
+    """
+    terms = cross_section_terms(lmdi_df, year, entities, fuels, benchmark=False, epsilon=epsilon)
+    names = terms['entities']
+    n = len(names)
+    shape = (n, n, len(RESULT_COLUMNS))
+    if path is None:
+        values = np.empty(shape)
+    else:
+        values = np.lib.format.open_memmap(path, mode='w+', dtype=float, shape=shape)
+    block_rows = max(1, block_pairs // max(n, 1))
+    for start in range(0, n, block_rows):
+        stop = min(start + block_rows, n)
+        idx0 = np.repeat(np.arange(start, stop), n)
+        idx1 = np.tile(np.arange(n), stop - start)
+        values[start:stop] = decompose_terms(terms, idx0, idx1).reshape(stop - start, n, len(RESULT_COLUMNS))
+    if path is not None:
+        values.flush()
+        labels = {'year': year, 'reference': list(map(str, names)), 'entities': list(map(str, names)),
+                  'columns': RESULT_COLUMNS}
+        with open(path + '.json', 'w', encoding='utf-8') as f:
+            json.dump(labels, f)
+    return values, names
+
+
+# === Step 7: Save Results ===
+YEARLY_CSV_PATH = 'lmdi_yearly_results_without_oil.csv'
+PANEL_CSV_PATH = 'lmdi_panel_results_without_oil.csv'
+MULTIPLICATIVE_CSV_PATH = 'lmdi_multiplicative_results_without_oil.csv'
+PANEL_MULTIPLICATIVE_CSV_PATH = 'lmdi_panel_multiplicative_results_without_oil.csv'
+HIERARCHY_CSV_PATH = 'lmdi_hierarchy_results_without_oil.csv'
+CROSS_SECTION_CSV_PATH = 'lmdi_cross_section_results_without_oil.csv'
+CROSS_MATRIX_PATH = 'lmdi_cross_matrix_without_oil.npy'
+PERIOD_MATRIX_CSV_PATH = 'lmdi_period_matrix_results_without_oil.csv'
+MONTE_CARLO_CSV_PATH = 'lmdi_monte_carlo_results_without_oil.csv'
+SCENARIOS_CSV_PATH = 'lmdi_scenario_results_without_oil.csv'
+ROBUSTNESS_CSV_PATH = 'lmdi_robustness_results_without_oil.csv'
+FUEL_ATTRIBUTION_PATH = 'lmdi_fuel_attribution_without_oil'
+PANEL_FUEL_ATTRIBUTION_PATH = 'lmdi_panel_fuel_attribution_without_oil'
+
+
+def overall_csv_path(start_year, end_year):
+    return f'lmdi_overall_{start_year}-{end_year}_results_without_oil.csv'
+
+
+def save_fuel_attribution(fuel_values, index, fuels, path):
+    """Сохраняет вклады топлив (строки, топлива, эффекты) рядом с итоговой таблицей.
+
+    .parquet - длинная таблица (строка, Fuel) x EFFECT_COLUMNS (нужен pyarrow);
+    иначе .npy, записанный через memmap, и подписи осей в path + '.json': коды строк
+    (строки, уровни индекса) - в path + '.index.npy', значения уровней - 'index_levels'.
+    index - индекс итоговой таблицы (Period или (объект, Period)), по строке на запись.
+    """
+    if os.path.splitext(path)[1].lower() in PARQUET_SUFFIXES:
+        rows = index.repeat(len(fuels)).to_frame(index=False)
+        rows['Fuel'] = np.tile(np.asarray(fuels, dtype=object), len(index))
+        values = pd.DataFrame(fuel_values.reshape(-1, len(EFFECT_COLUMNS)), columns=EFFECT_COLUMNS)
+        pd.concat([rows, values], axis=1).to_parquet(path, index=False)
+        return
+
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=fuel_values.dtype, shape=fuel_values.shape)
+    out[:] = fuel_values
+    out.flush()
+    del out
+    # Подписи строк - коды (строки, уровни индекса) в .npy и уникальные значения уровней
+    index = pd.MultiIndex.from_arrays([index]) if not isinstance(index, pd.MultiIndex) else index
+    levels = [pd.factorize(index.get_level_values(i)) for i in range(index.nlevels)]
+    np.save(path + '.index.npy', np.stack([codes for codes, _ in levels], axis=1).astype(np.int32))
+    labels = {
+        'index_names': list(index.names),
+        'index_levels': [list(map(str, uniques)) for _, uniques in levels],
+        'fuels': list(fuels),
+        'effects': EFFECT_COLUMNS,
+        'arrays': {'index_codes': os.path.basename(path) + '.index.npy'},
+    }
+    with open(path + '.json', 'w', encoding='utf-8') as f:
+        json.dump(labels, f)
+
+
+def load_labeled_npy(path):
+    """Открывает .npy без чтения в память вместе с подписями осей из path + '.json': (memmap, подписи).
+
+    Массивы подписей из labels['arrays'] (имя -> файл рядом с path) тоже открываются как memmap.
+    """
+    with open(path + '.json', encoding='utf-8') as f:
+        labels = json.load(f)
+    for name, file_name in labels.pop('arrays', {}).items():
+        labels[name] = np.load(os.path.join(os.path.dirname(path), file_name), mmap_mode='r')
+    return np.load(path, mmap_mode='r'), labels
+
+
+# Вклады топлив - (строки, топлива, эффекты); попарная матрица объектов - (N, N, RESULT_COLUMNS)
+load_fuel_attribution = load_cross_matrix = load_labeled_npy
+
+
+def save_overall(results_overall, path):
+    overall_results_to_save_df = pd.DataFrame([results_overall])
+    overall_results_to_save_df.set_index('Period', inplace=True)
+    overall_results_to_save_df = overall_results_to_save_df[RESULT_COLUMNS]
+    overall_results_to_save_df.to_csv(path, float_format='%.2f')
 
-    data0, data1 = lmdi_df.loc[year0], lmdi_df.loc[year1]
-    results = {'Period': period}
-    results['Total_Change'] = data1['Total_Emissions'] - data0['Total_Emissions']
 
-    # Промежуточные переменные
-    y0_raw, y1_raw = data0['Output'], data1['Output']
-    log_y_ratio = np.log(max(y1_raw, EPSILON) / max(y0_raw, EPSILON))
+# === Step 7b: Incremental Append of New Years ===
+STATE_PATH = 'lmdi_state.pkl'
 
-    vs0_raw = (data0['GVA_manu'] / y0_raw) if y0_raw != 0 else 0
-    vs1_raw = (data1['GVA_manu'] / y1_raw) if y1_raw != 0 else 0
-    log_vs_ratio = np.log(max(vs1_raw, EPSILON) / max(vs0_raw, EPSILON))
 
-    ei0_raw = (data0['Total_Energy'] / data0['GVA_manu']) if data0['GVA_manu'] != 0 else 0
-    ei1_raw = (data1['Total_Energy'] / data1['GVA_manu']) if data1['GVA_manu'] != 0 else 0
-    log_ei_ratio = np.log(max(ei1_raw, EPSILON) / max(ei0_raw, EPSILON))
+def save_state(lmdi_df, state_path=STATE_PATH):
+    """Сохраняет погодовые данные lmdi_df для последующего дополнения новыми годами"""
+    tmp_path = f'{state_path}.{os.getpid()}.tmp'
+    lmdi_df.to_pickle(tmp_path)
+    os.replace(tmp_path, state_path)
 
-    # Инициализация эффектов
-    prod_effect_sum, struct_effect_sum, intensity_effect_sum, mix_effect_sum, ef_effect_sum = 0, 0, 0, 0, 0
-    total_energy0, total_energy1 = data0['Total_Energy'], data1['Total_Energy']
 
-    # Расчет по каждому топливу
-    for fuel in energy_content.keys():
-        ci0, ci1 = data0[f'{fuel}_Emissions'], data1[f'{fuel}_Emissions']
-        L_ci = log_mean(ci0, ci1)
+def append_years(new_lmdi_df, state_path=STATE_PATH, yearly_csv_path=YEARLY_CSV_PATH,
+                 start_year=None, epsilon=EPSILON):
+    """Дополняет сохраненный ряд новыми годами без пересчета истории.
 
-        if abs(L_ci) < EPSILON and abs(ci0) < EPSILON and abs(ci1) < EPSILON:
-            continue
+    Считаются только новые последовательные периоды (от последнего сохраненного
+    года) и общий период start_year (по умолчанию первый сохраненный год) - новый
+    последний год; они дописываются в yearly_csv_path, состояние обновляется.
+    Возвращает (DataFrame новых периодов, словарь общего периода).
+    """
+    state_df = pd.read_pickle(state_path)
+    overlap = sorted(set(new_lmdi_df.index) & set(state_df.index))
+    if overlap:
+        raise ValueError(f"Years already stored in {state_path}: {overlap}")
+    if new_lmdi_df.empty:
+        raise ValueError("No new years to append.")
+    last_year = max(state_df.index)
+    if min(new_lmdi_df.index) < last_year:
+        raise ValueError(f"New years must follow the last stored year {last_year}.")
 
-        # Эффекты
-        prod_effect_sum += L_ci * log_y_ratio
-        struct_effect_sum += L_ci * log_vs_ratio
-        intensity_effect_sum += L_ci * log_ei_ratio
+    combined = pd.concat([state_df, new_lmdi_df[state_df.columns]]).sort_index()
+    # Погодовые величины только для последнего сохраненного года и новых лет
+    new_results_df = decompose_yearly(combined.loc[last_year:], epsilon=epsilon)
 
-        # Эффект структуры топливного микса
-        s0_raw = (data0[f'{fuel}_GJ'] / total_energy0) if total_energy0 > EPSILON else 0
-        s1_raw = (data1[f'{fuel}_GJ'] / total_energy1) if total_energy1 > EPSILON else 0
-        log_s_ratio = np.log(max(s1_raw, EPSILON) / max(s0_raw, EPSILON))
-        mix_effect_sum += L_ci * log_s_ratio
+    start_year = min(state_df.index) if start_year is None else start_year
+    end_year = max(combined.index)
+    results_overall = decompose_overall(combined.loc[[start_year, end_year]], start_year, end_year,
+                                        epsilon=epsilon)
 
-        # Эффект изменения коэффициентов выбросов
-        fuel_gj0, fuel_gj1 = data0[f'{fuel}_GJ'], data1[f'{fuel}_GJ']
-        ef0_calc = (ci0 / fuel_gj0) if fuel_gj0 > EPSILON else 0
-        ef1_calc = (ci1 / fuel_gj1) if fuel_gj1 > EPSILON else 0
+    write_header = not os.path.exists(yearly_csv_path)
+    new_results_df.to_csv(yearly_csv_path, mode='a', header=write_header, float_format='%.2f')
+    save_state(combined, state_path)
+    return new_results_df, results_overall
 
-        if abs(ef0_calc - ef1_calc) < EPSILON:
-            log_ef_ratio = 0.0
-        else:
-            log_ef_ratio = np.log(max(ef1_calc, EPSILON) / max(ef0_calc, EPSILON))
-        ef_effect_sum += L_ci * log_ef_ratio
-
-    # Сохранение результатов
-    results['Production'] = prod_effect_sum
-    results['Economic_Effect (GVA/Output)'] = struct_effect_sum
-    results['Intensity (Energy/GVA)'] = intensity_effect_sum
-    results['Mix (Fuel Share)'] = mix_effect_sum
-    results['Emission_Factor (CO2/Energy)'] = ef_effect_sum
-
-    # Проверка суммы
-    results['Sum_of_Effects'] = prod_effect_sum + struct_effect_sum + intensity_effect_sum + mix_effect_sum + ef_effect_sum
-    results['Difference'] = results['Total_Change'] - results['Sum_of_Effects']
-    all_results.append(results)
-
-if not all_results:
-    print("ERROR: No results were generated. Check data.")
-    exit()
-
-results_df = pd.DataFrame(all_results).set_index('Period')
-
-# === Step 7: Save Yearly Results ===
-print("\nLMDI Decomposition Results (Yearly Periods):")
-print("--------------------------------------------")
-print(results_df.to_string(float_format="%.2f"))
-yearly_csv_path = 'lmdi_yearly_results_without_oil.csv'
-results_df.to_csv(yearly_csv_path, float_format='%.2f')
-print(f"\nYearly results saved to {yearly_csv_path}")
 
 # === Step 8: Visualization ===
-plt.style.use('seaborn-v0_8-whitegrid')
-plot_cols_updated = ['Production', 'Economic_Effect (GVA/Output)', 'Intensity (Energy/GVA)', 'Mix (Fuel Share)', 'Emission_Factor (CO2/Energy)']
+# matplotlib и seaborn импортируются внутри функций, чтобы импорт модуля их не загружал
+plot_cols_updated = list(EFFECT_COLUMNS)
+colors = ['#3366CC', '#DC3912', '#109618', '#FF9900', '#990099', '#3B3B3B']
+
+# Имена графиков Steps 8-10 и файлы по умолчанию
+CHART_FILES = {
+    'yearly': 'lmdi_yearly_stacked_bar_without_oil.png',
+    'overall_bar': 'lmdi_overall_bar_chart_without_oil.png',
+    'waterfall': 'lmdi_overall_waterfall_without_oil.png',
+    'energy_mix': 'energy_mix_comparison_without_oil.png',
+    'emissions_by_fuel': 'emissions_by_fuel_type_without_oil.png',
+    'emissions_change': 'emissions_change_bar_chart_without_oil.png',
+}
+
+
+def _pyplot():
+    import matplotlib.pyplot as plt
+    plt.style.use('seaborn-v0_8-whitegrid')
+    return plt
+
 
 # --- 8a. Yearly Decomposition Trends ---
-if not results_df.empty:
-    plt.figure(figsize=(14, 8), dpi=100)
+def plot_yearly(results_df, start_year, end_year, path=CHART_FILES['yearly']):
+    plt = _pyplot()
+    fig = plt.figure(figsize=(14, 8), dpi=100)
     results_df[plot_cols_updated].plot(kind='bar', stacked=True, figsize=(14, 8),
                                        colormap='viridis', edgecolor='black', linewidth=0.5, ax=plt.gca())
     plt.plot(results_df.index, results_df['Total_Change'], marker='o', linestyle='--', color='red', 
              linewidth=2, markersize=6, label='Total Change')
-    plt.title(f'LMDI Decomposition of CO2 Emissions ({START_YEAR}-{END_YEAR}) - Yearly Changes', 
+    plt.title(f'LMDI Decomposition of CO2 Emissions ({start_year}-{end_year}) - Yearly Changes', 
               fontsize=16, fontweight='bold')
     plt.ylabel('Change in Emissions (tCO2)', fontsize=12)
     plt.xlabel('Period', fontsize=12)
@@ -246,95 +1996,15 @@ if not results_df.empty:
     plt.legend(title='Factors', bbox_to_anchor=(1.04, 1), loc='upper left')
     plt.grid(axis='y', linestyle='--', alpha=0.6)
     plt.tight_layout(rect=[0, 0, 0.85, 1])
-    plt.savefig('lmdi_yearly_stacked_bar_without_oil.png', dpi=300, bbox_inches='tight')
-    plt.show()
-else:
-    print("Skipping yearly plot as no results were generated.")
-
-# --- 8b. Overall Period Analysis ---
-if START_YEAR in lmdi_df.index and END_YEAR in lmdi_df.index and START_YEAR != END_YEAR:
-    print(f"\nCalculating overall LMDI for period {START_YEAR}-{END_YEAR}...")
-    data0_overall, data1_overall = lmdi_df.loc[START_YEAR], lmdi_df.loc[END_YEAR]
-    results_overall = {'Period': f"{START_YEAR}-{END_YEAR}"}
-    results_overall['Total_Change'] = data1_overall['Total_Emissions'] - data0_overall['Total_Emissions']
-
-    # Промежуточные переменные (overall)
-    y0_o_raw, y1_o_raw = data0_overall['Output'], data1_overall['Output']
-    log_y_o_ratio = np.log(max(y1_o_raw, EPSILON) / max(y0_o_raw, EPSILON))
-
-    vs0_o_raw = (data0_overall['GVA_manu'] / y0_o_raw) if y0_o_raw != 0 else 0
-    vs1_o_raw = (data1_overall['GVA_manu'] / y1_o_raw) if y1_o_raw != 0 else 0
-    log_vs_o_ratio = np.log(max(vs1_o_raw, EPSILON) / max(vs0_o_raw, EPSILON))
-
-    ei0_o_raw = (data0_overall['Total_Energy'] / data0_overall['GVA_manu']) if data0_overall['GVA_manu'] != 0 else 0
-    ei1_o_raw = (data1_overall['Total_Energy'] / data1_overall['GVA_manu']) if data1_overall['GVA_manu'] != 0 else 0
-    log_ei_o_ratio = np.log(max(ei1_o_raw, EPSILON) / max(ei0_o_raw, EPSILON))
-
-    prod_o, struct_o, intensity_o, mix_o, ef_o = 0, 0, 0, 0, 0
-    total_energy0_o, total_energy1_o = data0_overall['Total_Energy'], data1_overall['Total_Energy']
-
-    # Расчет эффектов (overall)
-    for fuel in energy_content.keys():
-        ci0_o, ci1_o = data0_overall[f'{fuel}_Emissions'], data1_overall[f'{fuel}_Emissions']
-        L_ci_o = log_mean(ci0_o, ci1_o)
-
-        if abs(L_ci_o) < EPSILON and abs(ci0_o) < EPSILON and abs(ci1_o) < EPSILON:
-            continue
-
-        prod_o += L_ci_o * log_y_o_ratio
-        struct_o += L_ci_o * log_vs_o_ratio
-        intensity_o += L_ci_o * log_ei_o_ratio
-
-        # Эффект структуры топливного микса
-        s0_o_raw = (data0_overall[f'{fuel}_GJ'] / total_energy0_o) if total_energy0_o > EPSILON else 0
-        s1_o_raw = (data1_overall[f'{fuel}_GJ'] / total_energy1_o) if total_energy1_o > EPSILON else 0
-        log_s_o_ratio = np.log(max(s1_o_raw, EPSILON) / max(s0_o_raw, EPSILON))
-        mix_o += L_ci_o * log_s_o_ratio
-
-        # Эффект изменения коэффициентов выбросов
-        fuel_gj0_o, fuel_gj1_o = data0_overall[f'{fuel}_GJ'], data1_overall[f'{fuel}_GJ']
-        ef0_o_calc = (ci0_o / fuel_gj0_o) if fuel_gj0_o > EPSILON else 0
-        ef1_o_calc = (ci1_o / fuel_gj1_o) if fuel_gj1_o > EPSILON else 0
-
-        if abs(ef0_o_calc - ef1_o_calc) < EPSILON:
-            log_ef_o_ratio = 0.0
-        else:
-            log_ef_o_ratio = np.log(max(ef1_o_calc, EPSILON) / max(ef0_o_calc, EPSILON))
-        ef_o += L_ci_o * log_ef_o_ratio
-
-    results_overall['Production'] = prod_o
-    results_overall['Economic_Effect (GVA/Output)'] = struct_o
-    results_overall['Intensity (Energy/GVA)'] = intensity_o
-    results_overall['Mix (Fuel Share)'] = mix_o
-    results_overall['Emission_Factor (CO2/Energy)'] = ef_o
-    results_overall['Sum_of_Effects'] = sum([results_overall[k] for k in plot_cols_updated])
-    results_overall['Difference'] = results_overall['Total_Change'] - results_overall['Sum_of_Effects']
-
-    # Вывод результатов (overall)
-    print("\nLMDI Decomposition Results (Overall Period):")
-    print("---------------------------------------------")
-    for k, v_val in results_overall.items():
-        if isinstance(v_val, (int, float)):
-            print(f"{k}: {v_val:,.2f} tCO2")
-        else:
-            print(f"{k}: {v_val}")
+    plt.savefig(path, dpi=300, bbox_inches='tight')
+    return fig
 
-    # Сохранение результатов (overall)
-    overall_results_to_save_df = pd.DataFrame([results_overall])
-    overall_results_to_save_df.set_index('Period', inplace=True)
-    overall_column_order = ['Total_Change'] + plot_cols_updated + ['Sum_of_Effects', 'Difference']
-    overall_results_to_save_df = overall_results_to_save_df[overall_column_order]
-    overall_csv_path = f'lmdi_overall_{START_YEAR}-{END_YEAR}_results_without_oil.csv'
-    try:
-        overall_results_to_save_df.to_csv(overall_csv_path, float_format='%.2f')
-        print(f"\nOverall period ({START_YEAR}-{END_YEAR}) LMDI results saved to {overall_csv_path}")
-    except Exception as e:
-        print(f"ERROR: Could not save overall LMDI results to CSV. Details: {e}")
 
-    # --- 8b. Overall Bar Chart ---
-    plt.figure(figsize=(12, 7), dpi=100)
+# --- 8b. Overall Bar Chart ---
+def plot_overall_bar(results_overall, start_year, end_year, path=CHART_FILES['overall_bar']):
+    plt = _pyplot()
+    fig = plt.figure(figsize=(12, 7), dpi=100)
     plot_effects_o = [results_overall.get(label, 0) for label in plot_cols_updated]
-    colors = ['#3366CC', '#DC3912', '#109618', '#FF9900', '#990099', '#3B3B3B']
     bars_o = plt.bar(plot_cols_updated, plot_effects_o, color=colors[:len(plot_cols_updated)], 
                      edgecolor='black', linewidth=0.5, alpha=0.8)
     plt.axhline(y=0, color='black', linestyle='--', alpha=0.5)
@@ -342,7 +2012,7 @@ if START_YEAR in lmdi_df.index and END_YEAR in lmdi_df.index and START_YEAR != E
     plt.text(len(plot_cols_updated) - 0.5, results_overall['Total_Change'],
              f'Total Change: {results_overall["Total_Change"]:,.0f} tCO2', 
              color='red', fontsize=10, ha='right')
-    plt.title(f'Overall LMDI Decomposition of CO2 Emissions ({START_YEAR}-{END_YEAR})', 
+    plt.title(f'Overall LMDI Decomposition of CO2 Emissions ({start_year}-{end_year})', 
               fontsize=16, fontweight='bold')
     plt.ylabel('Effect Size (tCO2)', fontsize=12)
     plt.xlabel('Decomposition Factors', fontsize=12)
@@ -361,12 +2031,15 @@ if START_YEAR in lmdi_df.index and END_YEAR in lmdi_df.index and START_YEAR != E
                 ha="left", fontsize=10, bbox={"facecolor": "white", "alpha": 0.5, "pad": 5})
     plt.grid(axis='y', linestyle='--', alpha=0.3)
     plt.tight_layout(rect=[0, 0.05, 1, 0.95])
-    plt.savefig('lmdi_overall_bar_chart_without_oil.png', dpi=300)
-    plt.show()
+    plt.savefig(path, dpi=300)
+    return fig
+
 
-    # --- 8c. Waterfall Chart ---
-    plt.figure(figsize=(12, 7))
-    values_o = plot_effects_o
+# --- 8c. Waterfall Chart ---
+def plot_waterfall(results_overall, start_year, end_year, path=CHART_FILES['waterfall']):
+    plt = _pyplot()
+    fig = plt.figure(figsize=(12, 7))
+    values_o = [results_overall.get(label, 0) for label in plot_cols_updated]
     total_o = results_overall['Total_Change']
     cumulative_sum = 0
     bottoms = [0] * len(values_o)
@@ -389,7 +2062,7 @@ if START_YEAR in lmdi_df.index and END_YEAR in lmdi_df.index and START_YEAR != E
     
     # Подписи
     plt.ylabel('Effect Size (tCO2)', fontsize=12)
-    plt.title(f'Overall LMDI Decomposition Waterfall ({START_YEAR}-{END_YEAR})', 
+    plt.title(f'Overall LMDI Decomposition Waterfall ({start_year}-{end_year})', 
               fontsize=16, fontweight='bold')
     plt.xticks(list(range(len(values_o))) + [len(values_o)], 
                plot_cols_updated + ['Total Change'], rotation=45, ha='right')
@@ -413,45 +2086,43 @@ if START_YEAR in lmdi_df.index and END_YEAR in lmdi_df.index and START_YEAR != E
 
     plt.grid(axis='y', linestyle='--', alpha=0.3)
     plt.tight_layout()
-    plt.savefig('lmdi_overall_waterfall_without_oil.png', dpi=300)
-    plt.show()
-else:
-    if START_YEAR == END_YEAR:
-        print(f"START_YEAR ({START_YEAR}) and END_YEAR ({END_YEAR}) are the same. Cannot generate overall plots.")
-    else:
-        print(f"Cannot generate overall ({START_YEAR}-{END_YEAR}) plots as data for these years is missing.")
+    plt.savefig(path, dpi=300)
+    return fig
+
 
 # === Step 9: Fuel Mix Comparison ===
-if START_YEAR in lmdi_df.index and END_YEAR in lmdi_df.index and START_YEAR != END_YEAR:
+def plot_energy_mix(lmdi_df, start_year, end_year, path=CHART_FILES['energy_mix']):
+    plt = _pyplot()
+    from matplotlib.patches import Patch
+
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 7))
-    fuels = list(energy_content.keys())
-    energy_start = lmdi_df.loc[START_YEAR][[f'{fuel}_GJ' for fuel in fuels]]
-    energy_end = lmdi_df.loc[END_YEAR][[f'{fuel}_GJ' for fuel in fuels]]
+    fuels = fuels_of(lmdi_df)
+    energy_start = lmdi_df.loc[start_year][[f'{fuel}_GJ' for fuel in fuels]]
+    energy_end = lmdi_df.loc[end_year][[f'{fuel}_GJ' for fuel in fuels]]
 
     # Очистка названий для легенды
     unique_fuels_idx = energy_start.index.union(energy_end.index).map(lambda x: x.replace('_GJ', ''))
     num_unique_fuels = len(unique_fuels_idx)
-    pie_colormap = plt.cm.get_cmap('viridis', max(num_unique_fuels, 1))
+    pie_colormap = plt.get_cmap('viridis', max(num_unique_fuels, 1))
     color_dict = {fuel_name: pie_colormap(i) for i, fuel_name in enumerate(unique_fuels_idx)}
 
-    # Пирог для START_YEAR
+    # Пирог для start_year
     energy_start_plot = energy_start[energy_start > 1e-6]
     labels_start = [f_name.replace('_GJ', '') for f_name in energy_start_plot.index]
     colors_start = [color_dict[label] for label in labels_start]
     if not energy_start_plot.empty:
         ax1.pie(energy_start_plot, autopct='%1.1f%%', startangle=90, colors=colors_start, pctdistance=0.85)
-    ax1.set_title(f'Energy Mix {START_YEAR}', fontsize=14)
+    ax1.set_title(f'Energy Mix {start_year}', fontsize=14)
 
-    # Пирог для END_YEAR
+    # Пирог для end_year
     energy_end_plot = energy_end[energy_end > 1e-6]
     labels_end = [f_name.replace('_GJ', '') for f_name in energy_end_plot.index]
     colors_end = [color_dict[label] for label in labels_end]
     if not energy_end_plot.empty:
         ax2.pie(energy_end_plot, autopct='%1.1f%%', startangle=90, colors=colors_end, pctdistance=0.85)
-    ax2.set_title(f'Energy Mix {END_YEAR}', fontsize=14)
+    ax2.set_title(f'Energy Mix {end_year}', fontsize=14)
 
     # Легенда
-    from matplotlib.patches import Patch
     active_fuel_names_gj = energy_start_plot.index.union(energy_end_plot.index)
     legend_handles = [Patch(facecolor=color_dict[f_name.replace('_GJ', '')], 
                            label=f_name.replace('_GJ', '')) 
@@ -461,30 +2132,30 @@ if START_YEAR in lmdi_df.index and END_YEAR in lmdi_df.index and START_YEAR != E
         fig.legend(handles=legend_handles, title="Fuel Types", loc="lower center", 
                    bbox_to_anchor=(0.5, -0.05), ncol=min(len(legend_handles), 4))
     
-    plt.suptitle(f'Change in Energy Mix ({START_YEAR}-{END_YEAR})', fontsize=16, fontweight='bold')
+    plt.suptitle(f'Change in Energy Mix ({start_year}-{end_year})', fontsize=16, fontweight='bold')
     plt.tight_layout(rect=[0, 0.05, 1, 0.95])
-    plt.savefig('energy_mix_comparison_without_oil.png', dpi=300, bbox_inches='tight')
-    plt.show()
-else:
-    print("Cannot generate energy mix comparison plot.")
+    plt.savefig(path, dpi=300, bbox_inches='tight')
+    return fig
+
 
 # === Step 10: Emissions by Fuel Type ===
-if START_YEAR in lmdi_df.index and END_YEAR in lmdi_df.index and START_YEAR != END_YEAR:
+def plot_emissions_by_fuel(lmdi_df, start_year, end_year, path=CHART_FILES['emissions_by_fuel']):
+    plt = _pyplot()
+    import seaborn as sns
+
     # Подготовка данных
+    fuels = fuels_of(lmdi_df)
     fuel_emissions_comp = pd.DataFrame({
-        'Year': [START_YEAR] * len(fuels) + [END_YEAR] * len(fuels),
-        'Fuel': list(energy_content.keys()) * 2,
-        'Emissions': [lmdi_df.loc[START_YEAR, f'{fuel}_Emissions'] for fuel in fuels] +
-                     [lmdi_df.loc[END_YEAR, f'{fuel}_Emissions'] for fuel in fuels]
+        'Year': [start_year] * len(fuels) + [end_year] * len(fuels),
+        'Fuel': fuels * 2,
+        'Emissions': [lmdi_df.loc[start_year, f'{fuel}_Emissions'] for fuel in fuels] +
+                     [lmdi_df.loc[end_year, f'{fuel}_Emissions'] for fuel in fuels]
     })
 
-    total_emissions_start = lmdi_df.loc[START_YEAR, 'Total_Emissions']
-    total_emissions_end = lmdi_df.loc[END_YEAR, 'Total_Emissions']
-
     # Диаграмма выбросов по топливам
-    plt.figure(figsize=(12, 7))
+    fig = plt.figure(figsize=(12, 7))
     emissions_plot = sns.barplot(x='Fuel', y='Emissions', hue='Year', data=fuel_emissions_comp, palette='viridis')
-    plt.title(f'CO2 Emissions by Fuel Type ({START_YEAR} vs {END_YEAR})', fontsize=16, fontweight='bold')
+    plt.title(f'CO2 Emissions by Fuel Type ({start_year} vs {end_year})', fontsize=16, fontweight='bold')
     plt.ylabel('Emissions (tCO2)', fontsize=12)
     plt.xlabel('Fuel Type', fontsize=12)
     plt.xticks(rotation=45, ha='right')
@@ -492,39 +2163,822 @@ if START_YEAR in lmdi_df.index and END_YEAR in lmdi_df.index and START_YEAR != E
     for container in emissions_plot.containers:
         emissions_plot.bar_label(container, fmt='%.0f', fontsize=9, padding=3)
     plt.tight_layout()
-    plt.savefig('emissions_by_fuel_type_without_oil.png', dpi=300)
-    plt.show()
+    plt.savefig(path, dpi=300)
+    return fig
+
 
-    # Изменение выбросов по топливам
-    fuel_changes = {fuel: lmdi_df.loc[END_YEAR, f'{fuel}_Emissions'] - 
-                            lmdi_df.loc[START_YEAR, f'{fuel}_Emissions'] for fuel in fuels}
+def plot_emissions_change(lmdi_df, start_year, end_year, epsilon=EPSILON,
+                          path=CHART_FILES['emissions_change']):
+    """Изменение выбросов по топливам; None, если изменений нет"""
+    fuels = fuels_of(lmdi_df)
+    fuel_changes = {fuel: lmdi_df.loc[end_year, f'{fuel}_Emissions'] - 
+                            lmdi_df.loc[start_year, f'{fuel}_Emissions'] for fuel in fuels}
     changes_df = pd.DataFrame(list(fuel_changes.items()), columns=['Fuel', 'Change']).sort_values('Change', ascending=False)
-    changes_df = changes_df[changes_df['Change'].abs() > EPSILON]
-
-    if not changes_df.empty:
-        plt.figure(figsize=(10, 7))
-        change_plot = sns.barplot(y='Fuel', x='Change', data=changes_df, palette='RdBu_r', orient='h',
-                                  edgecolor='black', linewidth=0.5)
-        plt.title(f'Change in CO2 Emissions by Fuel Type ({START_YEAR}-{END_YEAR})', 
-                  fontsize=16, fontweight='bold')
-        plt.xlabel('Change in Emissions (tCO2)', fontsize=12)
-        plt.ylabel('Fuel Type', fontsize=12)
-        plt.axvline(0, color='k', linestyle='--', alpha=0.7)
-        for bar in change_plot.patches:
-            value = bar.get_width()
-            y_pos = bar.get_y() + bar.get_height() / 2
-            offset = abs(changes_df['Change']).max() * 0.02
-            ha_align = 'left' if value >= 0 else 'right'
-            text_x_pos = value + offset * np.sign(value) if value != 0 else offset
-            plt.text(text_x_pos, y_pos, f'{value:,.0f}', va='center', ha=ha_align, fontsize=9)
-        plt.tight_layout()
-        plt.savefig('emissions_change_bar_chart_without_oil.png', dpi=300)
-        plt.show()
+    changes_df = changes_df[changes_df['Change'].abs() > epsilon]
+    if changes_df.empty:
+        return None
+
+    plt = _pyplot()
+    import seaborn as sns
+
+    fig = plt.figure(figsize=(10, 7))
+    change_plot = sns.barplot(y='Fuel', x='Change', data=changes_df, palette='RdBu_r', orient='h',
+                              edgecolor='black', linewidth=0.5)
+    plt.title(f'Change in CO2 Emissions by Fuel Type ({start_year}-{end_year})', 
+              fontsize=16, fontweight='bold')
+    plt.xlabel('Change in Emissions (tCO2)', fontsize=12)
+    plt.ylabel('Fuel Type', fontsize=12)
+    plt.axvline(0, color='k', linestyle='--', alpha=0.7)
+    for bar in change_plot.patches:
+        value = bar.get_width()
+        y_pos = bar.get_y() + bar.get_height() / 2
+        offset = abs(changes_df['Change']).max() * 0.02
+        ha_align = 'left' if value >= 0 else 'right'
+        text_x_pos = value + offset * np.sign(value) if value != 0 else offset
+        plt.text(text_x_pos, y_pos, f'{value:,.0f}', va='center', ha=ha_align, fontsize=9)
+    plt.tight_layout()
+    plt.savefig(path, dpi=300)
+    return fig
+
+
+CHART_FUNCTIONS = {
+    'yearly': plot_yearly,
+    'overall_bar': plot_overall_bar,
+    'waterfall': plot_waterfall,
+    'energy_mix': plot_energy_mix,
+    'emissions_by_fuel': plot_emissions_by_fuel,
+    'emissions_change': plot_emissions_change,
+}
+
+
+# === Step 11: Plotly Chart Payloads ===
+# Данные графиков Steps 8-10 в виде {'data': [трассы], 'layout': {...}} для PlotlyChart.tsx;
+# без matplotlib, значения округлены как в CSV
+CHART_JSON_PATH = 'lmdi_charts_without_oil.json'
+
+
+def _plotly_values(values, decimals=2):
+    """Список чисел для JSON: округление, NaN и бесконечности -> None"""
+    values = np.round(np.asarray(values, dtype=float), decimals)
+    return [None if not np.isfinite(v) else float(v) for v in values]
+
+
+def plotly_yearly(results_df, start_year, end_year):
+    periods = list(results_df.index)
+    data = [{'x': periods, 'y': _plotly_values(results_df[col]), 'type': 'bar', 'name': col,
+             'marker': {'color': colors[i]}} for i, col in enumerate(plot_cols_updated)]
+    data.append({'x': periods, 'y': _plotly_values(results_df['Total_Change']), 'type': 'scatter',
+                 'mode': 'lines+markers', 'name': 'Total Change', 'line': {'color': 'red', 'dash': 'dash'}})
+    layout = {
+        'title': f'LMDI Decomposition of CO2 Emissions ({start_year}-{end_year}) - Yearly Changes',
+        'xaxis': {'title': 'Period'},
+        'yaxis': {'title': 'Change in Emissions (tCO2)'},
+        'barmode': 'relative',
+    }
+    return {'data': data, 'layout': layout}
+
+
+def plotly_overall_bar(results_overall, start_year, end_year):
+    values = _plotly_values([results_overall.get(label, 0) for label in plot_cols_updated])
+    total = _plotly_values([results_overall['Total_Change']])[0]
+    data = [{'x': plot_cols_updated, 'y': values, 'type': 'bar', 'name': 'Effect',
+             'marker': {'color': colors[:len(plot_cols_updated)]}, 'text': values, 'texttemplate': '%{y:,.0f}'}]
+    layout = {
+        'title': f'Overall LMDI Decomposition of CO2 Emissions ({start_year}-{end_year})',
+        'xaxis': {'title': 'Decomposition Factors'},
+        'yaxis': {'title': 'Effect Size (tCO2)'},
+        'shapes': [{'type': 'line', 'xref': 'paper', 'x0': 0, 'x1': 1, 'y0': total, 'y1': total,
+                    'line': {'color': 'red'}, 'opacity': 0.3}],
+        'annotations': [{'xref': 'paper', 'x': 1, 'y': total, 'xanchor': 'right', 'showarrow': False,
+                         'text': f'Total Change: {results_overall["Total_Change"]:,.0f} tCO2',
+                         'font': {'color': 'red'}}],
+    }
+    return {'data': data, 'layout': layout}
+
+
+def plotly_waterfall(results_overall, start_year, end_year):
+    """Шаги эффектов и итог Total_Change (как в plot_waterfall, итог - не сумма шагов)"""
+    values = [results_overall.get(label, 0) for label in plot_cols_updated] + [results_overall['Total_Change']]
+    data = [{'type': 'waterfall', 'x': plot_cols_updated + ['Total Change'], 'y': _plotly_values(values),
+             'measure': ['relative'] * len(plot_cols_updated) + ['absolute'], 'texttemplate': '%{y:,.0f}',
+             'connector': {'line': {'dash': 'dash'}}}]
+    layout = {
+        'title': f'Overall LMDI Decomposition Waterfall ({start_year}-{end_year})',
+        'yaxis': {'title': 'Effect Size (tCO2)'},
+        'showlegend': False,
+    }
+    return {'data': data, 'layout': layout}
+
+
+def plotly_energy_mix(lmdi_df, start_year, end_year):
+    """Доли топлив в энергии start_year и end_year: два круга рядом"""
+    fuels = fuels_of(lmdi_df)
+    data = []
+    for i, year in enumerate((start_year, end_year)):
+        energy = lmdi_df.loc[year, [f'{fuel}_GJ' for fuel in fuels]].to_numpy(dtype=float)
+        keep = energy > 1e-6
+        shares = energy[keep] / energy[keep].sum() if keep.any() else energy[keep]
+        data.append({'type': 'pie', 'labels': [fuel for fuel, k in zip(fuels, keep) if k],
+                     'values': _plotly_values(shares, 4), 'name': str(year), 'title': f'Energy Mix {year}',
+                     'domain': {'column': i}, 'sort': False, 'textinfo': 'percent'})
+    layout = {
+        'title': f'Change in Energy Mix ({start_year}-{end_year})',
+        'grid': {'rows': 1, 'columns': 2},
+        'legend': {'title': {'text': 'Fuel Types'}, 'orientation': 'h'},
+    }
+    return {'data': data, 'layout': layout}
+
+
+def plotly_emissions_by_fuel(lmdi_df, start_year, end_year):
+    fuels = fuels_of(lmdi_df)
+    data = [{'x': fuels, 'y': _plotly_values(lmdi_df.loc[year, [f'{fuel}_Emissions' for fuel in fuels]]),
+             'type': 'bar', 'name': str(year), 'texttemplate': '%{y:.0f}'} for year in (start_year, end_year)]
+    layout = {
+        'title': f'CO2 Emissions by Fuel Type ({start_year} vs {end_year})',
+        'xaxis': {'title': 'Fuel Type'},
+        'yaxis': {'title': 'Emissions (tCO2)'},
+        'barmode': 'group',
+        'legend': {'title': {'text': 'Year'}},
+    }
+    return {'data': data, 'layout': layout}
+
+
+def plotly_emissions_change(lmdi_df, start_year, end_year, epsilon=EPSILON):
+    """Изменение выбросов по топливам (по убыванию); None, если изменений нет"""
+    fuels = fuels_of(lmdi_df)
+    cols = [f'{fuel}_Emissions' for fuel in fuels]
+    change = lmdi_df.loc[end_year, cols].to_numpy(dtype=float) - lmdi_df.loc[start_year, cols].to_numpy(dtype=float)
+    order = [j for j in np.argsort(-change, kind='stable') if abs(change[j]) > epsilon]
+    if not order:
+        return None
+    data = [{'y': [fuels[j] for j in order], 'x': _plotly_values(change[order]), 'type': 'bar',
+             'orientation': 'h', 'texttemplate': '%{x:,.0f}',
+             'marker': {'color': _plotly_values(change[order]), 'colorscale': 'RdBu', 'reversescale': True,
+                        'cmid': 0}}]
+    layout = {
+        'title': f'Change in CO2 Emissions by Fuel Type ({start_year}-{end_year})',
+        'xaxis': {'title': 'Change in Emissions (tCO2)'},
+        'yaxis': {'title': 'Fuel Type', 'autorange': 'reversed'},
+    }
+    return {'data': data, 'layout': layout}
+
+
+PLOTLY_FUNCTIONS = {
+    'yearly': plotly_yearly,
+    'overall_bar': plotly_overall_bar,
+    'waterfall': plotly_waterfall,
+    'energy_mix': plotly_energy_mix,
+    'emissions_by_fuel': plotly_emissions_by_fuel,
+    'emissions_change': plotly_emissions_change,
+}
+
+
+def chart_payloads(results_df, results_overall, lmdi_df, start_year, end_year, charts=None):
+    """Данные выбранных графиков {имя: {'data', 'layout'}} (те же графики, что у chart_jobs)"""
+    charts = list(CHART_FILES) if charts is None else list(charts)
+    unknown = [name for name in charts if name not in PLOTLY_FUNCTIONS]
+    if unknown:
+        raise ValueError(f"Unknown charts: {unknown}. Available: {list(PLOTLY_FUNCTIONS)}")
+
+    payloads = {}
+    if 'yearly' in charts and not results_df.empty:
+        payloads['yearly'] = plotly_yearly(results_df, start_year, end_year)
+    if results_overall is None:
+        return payloads
+    for name in charts:
+        if name in ('overall_bar', 'waterfall'):
+            payloads[name] = PLOTLY_FUNCTIONS[name](results_overall, start_year, end_year)
+        elif name != 'yearly':
+            figure = PLOTLY_FUNCTIONS[name](lmdi_df, start_year, end_year)
+            if figure is not None:
+                payloads[name] = figure
+    return payloads
+
+
+def save_chart_payloads(payloads, path=CHART_JSON_PATH):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(payloads, f, separators=(',', ':'), allow_nan=False)
+
+
+def _render_chart(job):
+    """Строит один график в неинтерактивном бэкенде Agg; возвращает путь или None"""
+    name, path, args = job
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig = CHART_FUNCTIONS[name](*args, path=path)
+    if fig is None:
+        return None
+    plt.close(fig)
+    return path
+
+
+def chart_jobs(results_df, results_overall, lmdi_df, start_year, end_year, charts=None,
+               out_dir='.', prefix='', verbose=True):
+    """Задания (имя, путь, аргументы) для выбранных графиков charts (по умолчанию все)"""
+    charts = list(CHART_FILES) if charts is None else list(charts)
+    unknown = [name for name in charts if name not in CHART_FILES]
+    if unknown:
+        raise ValueError(f"Unknown charts: {unknown}. Available: {list(CHART_FILES)}")
+
+    def path(name):
+        return os.path.join(out_dir, prefix + CHART_FILES[name])
+
+    jobs = []
+    if 'yearly' in charts:
+        if not results_df.empty:
+            jobs.append(('yearly', path('yearly'), (results_df, start_year, end_year)))
+        elif verbose:
+            print("Skipping yearly plot as no results were generated.")
+
+    overall_charts = [name for name in charts if name != 'yearly']
+    if results_overall is None:
+        if overall_charts and verbose:
+            if start_year == end_year:
+                print(f"START_YEAR ({start_year}) and END_YEAR ({end_year}) are the same. Cannot generate overall plots.")
+            else:
+                print(f"Cannot generate overall ({start_year}-{end_year}) plots as data for these years is missing.")
+        return jobs
+
+    # Воркерам передаются только два нужных года
+    endpoints_df = lmdi_df.loc[[start_year, end_year]]
+    for name in overall_charts:
+        if name in ('overall_bar', 'waterfall'):
+            jobs.append((name, path(name), (results_overall, start_year, end_year)))
+        else:
+            jobs.append((name, path(name), (endpoints_df, start_year, end_year)))
+    return jobs
+
+
+def render_charts(jobs, processes=None):
+    """Строит графики в пуле процессов без plt.show(); возвращает пути сохраненных файлов.
+
+    processes=1 строит в текущем процессе; None - по числу ядер (не больше числа заданий).
+    """
+    if not jobs:
+        return []
+    if processes is None:
+        processes = min(len(jobs), os.cpu_count() or 1)
+    if processes <= 1:
+        paths = [_render_chart(job) for job in jobs]
     else:
-        print("Skipping emissions change bar chart due to empty data.")
-else:
-    print("Cannot generate fuel-specific comparison plots for emissions.")
+        # Воркеры не наследуют трассировку памяти родителя (tracemalloc.stop без трассировки безопасен)
+        with ProcessPoolExecutor(max_workers=processes, initializer=tracemalloc.stop) as executor:
+            paths = list(executor.map(_render_chart, jobs, chunksize=max(1, len(jobs) // (processes * 4))))
+    return [path for path in paths if path is not None]
+
+
+def _entity_results(panel_results_df, start_year, end_year):
+    """(объект, годовые результаты, словарь общего периода или None) для каждого объекта панели"""
+    overall_label = f"{start_year}-{end_year}"
+    for entity, entity_results in panel_results_df.groupby(level=0, sort=False, observed=True):
+        entity_results = entity_results.droplevel(0)
+        yearly_df = entity_results
+        if len(entity_results) > 1:
+            yearly_df = entity_results[entity_results.index != overall_label]
+        results_overall = None
+        if overall_label in entity_results.index:
+            results_overall = {'Period': overall_label}
+            results_overall.update(entity_results.loc[overall_label, RESULT_COLUMNS].items())
+        yield entity, yearly_df, results_overall
+
+
+def panel_chart_jobs(panel_results_df, lmdi_df, start_year, end_year, charts=None, out_dir='.'):
+    """Задания графиков для каждого объекта панели; файлы с префиксом '<объект>_'"""
+    jobs = []
+    for entity, yearly_df, results_overall in _entity_results(panel_results_df, start_year, end_year):
+        jobs.extend(chart_jobs(yearly_df, results_overall, lmdi_df.xs(entity, level=0),
+                               start_year, end_year, charts, out_dir, prefix=f'{entity}_', verbose=False))
+    return jobs
+
+
+def panel_chart_payloads(panel_results_df, lmdi_df, start_year, end_year, charts=None):
+    """chart_payloads для каждого объекта панели: {объект: {имя: {'data', 'layout'}}}"""
+    return {str(entity): chart_payloads(yearly_df, results_overall, lmdi_df.xs(entity, level=0),
+                                        start_year, end_year, charts)
+            for entity, yearly_df, results_overall in _entity_results(panel_results_df, start_year, end_year)}
+
+
+# === Command Line Interface ===
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="LMDI decomposition of manufacturing CO2 emissions.")
+    parser.add_argument('file', help="input data: Excel, CSV, Parquet or Arrow/Feather; a quoted glob such as "
+                                     "'regions/*.xlsx' loads every matching file into one panel")
+    parser.add_argument('--sheet', default=SHEET_NAME,
+                        help=f"sheet name, comma-separated sheets or '{ALL_SHEETS}' for all sheets "
+                             f"(default: {SHEET_NAME})")
+    parser.add_argument('--load-processes', type=int,
+                        help="processes for loading several files (default: number of CPUs, 1 = in-process)")
+    parser.add_argument('--start-year', type=int, default=START_YEAR, help=f"first year (default: {START_YEAR})")
+    parser.add_argument('--end-year', type=int, default=END_YEAR, help=f"last year (default: {END_YEAR})")
+    parser.add_argument('--epsilon', type=float, default=EPSILON, help=f"log-mean epsilon (default: {EPSILON})")
+    parser.add_argument('--entity-column',
+                        help="entity column (plant, region, sector) for panel mode, e.g. 'Plant'")
+    parser.add_argument('--fuel-registry',
+                        help="CSV/JSON fuel registry (Fuel, NCV, Emission_Factor, Multiplier, Column) "
+                             "used instead of the built-in coefficient tables")
+    parser.add_argument('--hierarchy',
+                        help="file with level columns top-down, the last one holding the --entity-column "
+                             "values (e.g. Sector, Subsector, Plant); adds a decomposition of every level")
+    parser.add_argument('--cross-section', type=int, metavar='YEAR',
+                        help="panel mode: decompose the difference between each entity and --reference in YEAR")
+    parser.add_argument('--reference', default=BENCHMARK_NAME,
+                        help=f"reference entity for --cross-section (default: '{BENCHMARK_NAME}', the average entity)")
+    parser.add_argument('--cross-matrix', action='store_true',
+                        help=f"with --cross-section also save the entity x entity matrix to {CROSS_MATRIX_PATH}")
+    parser.add_argument('--float32', action='store_true', help="read input values as float32")
+    parser.add_argument('--store',
+                        help="panel mode: save entity x year x fuel arrays as memory-mapped .npy files in this "
+                             "folder, filled from the input in --chunksize row blocks (CSV/Parquet), and decompose "
+                             "from them in entity blocks (--float32 halves the size)")
+    parser.add_argument('--store-processes', type=int,
+                        help="processes sharing the --store read-only (default: number of CPUs, 1 = in-process)")
+    parser.add_argument('--write-sidecar', action='store_true',
+                        help="save a columnar Feather copy of the Excel sheet for faster later runs")
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+                        help=f"cache of converted data (default: {CACHE_DIR})")
+    parser.add_argument('--no-cache', action='store_true', help="always parse and convert the input")
+    parser.add_argument('--multiplicative', action='store_true',
+                        help="also save the multiplicative form (factors whose product is E1/E0) "
+                             "from the same decomposition pass")
+    parser.add_argument('--period-matrix', action='store_true',
+                        help="also decompose every (year0, year1) pair with year0 < year1")
+    parser.add_argument('--monte-carlo', type=int, metavar='N',
+                        help="propagate coefficient uncertainty with N samples (requires --mc-spec)")
+    parser.add_argument('--mc-spec', help="JSON file {'ncv': {fuel: [dist, ...]}, 'ef': {...}}")
+    parser.add_argument('--seed', type=int, help="random seed for --monte-carlo and --robustness")
+    parser.add_argument('--robustness', type=int, metavar='N',
+                        help="leave-one-year-out and N bootstrap replicates of the overall period "
+                             "(0 = leave-one-year-out only)")
+    parser.add_argument('--bootstrap-sigma', type=float, default=0.05,
+                        help="log-scale error of fuel consumption in --robustness replicates (default: 0.05)")
+    parser.add_argument('--robustness-processes', type=int,
+                        help="processes for --robustness (default: number of CPUs, 1 = in-process)")
+    parser.add_argument('--fuel-attribution', choices=['npy', 'parquet'],
+                        help="also save per-fuel contributions (periods x fuels x effects) in this format")
+    parser.add_argument('--scenarios',
+                        help="JSON file with a list of {'name', 'ncv': {fuel: value}, 'ef': {...}} scenarios "
+                             "or a grid {'ncv': {fuel: [values]}, 'ef': {...}}")
+    parser.add_argument('--records',
+                        help="stream fuel consumption records (CSV/Parquet, col_mapping columns) from this "
+                             "file; the positional file then holds only Output/GVA/GDP per year")
+    parser.add_argument('--date-column', default='Year', help="year or date column of --records")
+    parser.add_argument('--chunksize', type=int, default=STREAM_CHUNKSIZE, help="rows per --records or --store chunk")
+    parser.add_argument('--state', help="save the per-year data here so later runs can use --append")
+    parser.add_argument('--append', action='store_true',
+                        help="decompose only years newer than those in --state and append them to "
+                             f"{YEARLY_CSV_PATH} (set --end-year to include the new years; no charts or extra outputs)")
+    parser.add_argument('--run-report', help="save stage timings, CPU time and peak memory to this JSON file")
+    parser.add_argument('--timings', action='store_true', help="print the time of each stage to stderr")
+    parser.add_argument('--no-plots', action='store_true', help="skip charts (numbers only)")
+    parser.add_argument('--charts', help=f"'all' or comma-separated subset of charts: {', '.join(CHART_FILES)} "
+                                         "(panel mode draws charts per entity only when this is given)")
+    parser.add_argument('--chart-format', choices=['png', 'plotly'], default='png',
+                        help="'png' renders 300-dpi images; 'plotly' writes the chart data as compact JSON "
+                             f"for the web front end to {CHART_JSON_PATH} without loading matplotlib")
+    parser.add_argument('--chart-processes', type=int,
+                        help="processes for chart rendering (default: number of CPUs, 1 = in-process)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = None
+    if args.run_report or args.timings:
+        profiler = RunProfiler(hooks=[print_stage] if args.timings else [])
+    try:
+        return run(args, profiler)
+    finally:
+        if profiler is not None and args.run_report:
+            profiler.save(args.run_report)
+            print(f"Run report saved to {args.run_report}")
+
+
+def run_robustness(args, lmdi_df, profiler=None):
+    """--robustness: сводка реплик в ROBUSTNESS_CSV_PATH; возвращает код завершения"""
+    print(f"\nRunning leave-one-year-out and {args.robustness} bootstrap replicates...")
+    try:
+        with stage(profiler, 'robustness', replicates=args.robustness, rows=len(lmdi_df)):
+            robustness_df = robustness(lmdi_df, args.start_year, args.end_year, n_bootstrap=args.robustness,
+                                       sigma=args.bootstrap_sigma, processes=args.robustness_processes,
+                                       seed=args.seed, epsilon=args.epsilon)
+    except ValueError as e:
+        print(f"ERROR: Could not run the robustness analysis. Details: {e}")
+        return 1
+    robustness_df.to_csv(ROBUSTNESS_CSV_PATH, float_format='%.2f')
+    print(f"Robustness summaries saved to {ROBUSTNESS_CSV_PATH}")
+    return 0
+
+
+def run_store(args, registry, profiler=None):
+    """--store: вход пишется в хранилище блоками, разложение - по срезам memmap; возвращает код завершения"""
+    print(f"Streaming {args.file} into the array store {args.store}...")
+    try:
+        with stage(profiler, 'store_write') as info:
+            store = stream_store(args.file, args.store, args.entity_column, args.start_year, args.end_year,
+                                 sheet_name=args.sheet, chunksize=args.chunksize,
+                                 float_dtype='float32' if args.float32 else 'float64', **registry)
+            info.update(entities=len(store['entities']), fuels=len(store['fuels']))
+    except FileNotFoundError:
+        print(f"ERROR: File not found at {args.file}")
+        return 1
+    except Exception as e:
+        print(f"ERROR: Could not read input file. Details: {e}")
+        return 1
+    print(f"Array store saved to {args.store}")
+
+    print("\nCalculating LMDI Decomposition for all entities...")
+    try:
+        with stage(profiler, 'decompose') as info:
+            panel_results = decompose_store(store, args.start_year, args.end_year, processes=args.store_processes,
+                                            epsilon=args.epsilon, multiplicative=args.multiplicative)
+            info.update(entities=len(store['entities']), fuels=len(store['fuels']))
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        return 1
+    if args.multiplicative:
+        panel_results, panel_multiplicative_df = panel_results
+        panel_multiplicative_df.to_csv(PANEL_MULTIPLICATIVE_CSV_PATH, float_format='%.6f')
+        print(f"Multiplicative panel results saved to {PANEL_MULTIPLICATIVE_CSV_PATH}")
+    n_entities = panel_results.index.get_level_values(0).nunique()
+    print(f"  Processed {len(panel_results)} (entity, period) rows for {n_entities} entities.")
+    with stage(profiler, 'save_csv', periods=len(panel_results)):
+        panel_results.to_csv(PANEL_CSV_PATH, float_format='%.2f')
+    print(f"\nPanel results saved to {PANEL_CSV_PATH}")
+    print("\n=== Script finished successfully ===")
+    return 0
+
+
+def run(args, profiler=None):
+    """Расчет по разобранным аргументам CLI; возвращает код завершения"""
+    start_year, end_year, epsilon = args.start_year, args.end_year, args.epsilon
+    charts = [name.strip() for name in args.charts.split(',') if name.strip()] if args.charts else None
+    if charts == ['all']:
+        charts = list(CHART_FILES)
+    unknown = [name for name in charts or [] if name not in CHART_FILES]
+    if unknown:
+        print(f"ERROR: Unknown charts: {unknown}. Available: {', '.join(CHART_FILES)}")
+        return 1
+
+    if args.hierarchy and not args.entity_column:
+        print("ERROR: --hierarchy requires --entity-column.")
+        return 1
+
+    registry = {}
+    if args.fuel_registry:
+        try:
+            registry = load_fuel_registry(args.fuel_registry)
+        except (OSError, ValueError) as e:
+            print(f"ERROR: Could not read fuel registry. Details: {e}")
+            return 1
+        print(f"Fuel registry loaded from {args.fuel_registry}: {len(registry['ncv'])} fuels")
+
+    # Несколько файлов (шаблон glob) или листов загружаются параллельно
+    sheets = [sheet.strip() for sheet in args.sheet.split(',') if sheet.strip()]
+    multi_input = glob.has_magic(args.file) or len(sheets) > 1 or sheets == [ALL_SHEETS]
+    # Без --entity-column объектом панели становится файл; листы одной книги - это один ряд
+    entity_column = args.entity_column or (SOURCE_COLUMN if glob.has_magic(args.file) else None)
+    # Панельный режим не поддерживает режимы ряда - отказ до загрузки, а не молча
+    if entity_column:
+        panel_source = '--entity-column' if args.entity_column else 'a file pattern'
+        for flag, value in (('--period-matrix', args.period_matrix), ('--monte-carlo', args.monte_carlo),
+                            ('--scenarios', args.scenarios), ('--state', args.state), ('--append', args.append)):
+            if value:
+                print(f"ERROR: {flag} cannot be combined with {panel_source}.")
+                return 1
+    else:
+        for flag, value in (('--cross-section', args.cross_section is not None), ('--cross-matrix', args.cross_matrix),
+                            ('--store', args.store)):
+            if value:
+                print(f"ERROR: {flag} requires --entity-column.")
+                return 1
+    if args.cross_matrix and args.cross_section is None:
+        print("ERROR: --cross-matrix requires --cross-section.")
+        return 1
+    # --append только дописывает новые годовые периоды и общий период; остальные выходы - полным прогоном
+    if args.append:
+        for flag, value in (('--multiplicative', args.multiplicative), ('--period-matrix', args.period_matrix),
+                            ('--fuel-attribution', args.fuel_attribution), ('--monte-carlo', args.monte_carlo),
+                            ('--scenarios', args.scenarios), ('--robustness', args.robustness is not None),
+                            ('--charts', args.charts), ('--chart-format plotly', args.chart_format == 'plotly')):
+            if value:
+                print(f"ERROR: {flag} cannot be combined with --append.")
+                return 1
+
+    # Хранилище заполняется прямо из одного входного файла; режимы, которым нужна вся панель в памяти, - отказ
+    if args.store:
+        for flag, value in (('--fuel-attribution', args.fuel_attribution), ('--hierarchy', args.hierarchy),
+                            ('--robustness', args.robustness is not None),
+                            ('--cross-section', args.cross_section is not None), ('--charts', args.charts),
+                            ('--records', args.records), ('several input files or sheets', multi_input)):
+            if value:
+                print(f"ERROR: --store cannot be combined with {flag}.")
+                return 1
+        return run_store(args, registry, profiler)
+
+    print(f"Loading data from: {args.file}")
+    try:
+        if multi_input and not args.records:
+            load_kwargs = {'float_dtype': 'float32' if args.float32 else 'float64'}
+            if registry:
+                load_kwargs['required_cols'] = list(registry['mapping'].values()) + other_required_cols
+            with stage(profiler, 'read') as info:
+                df, errors = load_many([args.file], sheets, start_year, end_year, args.entity_column,
+                                       processes=args.load_processes, **load_kwargs)
+                info.update(rows=0 if df is None else len(df), failed=len(errors))
+            for path, error in errors.items():
+                print(f"ERROR: {path}: {error}")
+            if df is None:
+                print("ERROR: None of the input files could be read.")
+                return 1
+            if not entity_column:
+                df = df.droplevel(SOURCE_COLUMN)
+            with stage(profiler, 'convert') as info:
+                lmdi_df = convert_units(df, **registry)
+                info.update(rows=len(lmdi_df), fuels=len(fuels_of(lmdi_df)))
+            print(f"Input files loaded successfully ({len(errors)} failed).")
+        elif args.records:
+            with stage(profiler, 'read') as info:
+                activity_df = load_data(args.file, args.sheet, start_year, end_year,
+                                        entity_column=args.entity_column, required_cols=other_required_cols)
+                info['rows'] = len(activity_df)
+            print(f"Streaming consumption records from: {args.records}")
+            with stage(profiler, 'stream_aggregate') as info:
+                lmdi_df = stream_aggregate(args.records, activity_df, args.entity_column, args.date_column,
+                                           start_year, end_year, args.chunksize, **registry)
+                info.update(rows=len(lmdi_df), fuels=len(active_fuels(lmdi_df)))
+            print("Consumption records aggregated successfully.")
+        else:
+            lmdi_df, from_cache = load_converted(args.file, args.sheet, start_year, end_year,
+                                                 entity_column=args.entity_column,
+                                                 float_dtype='float32' if args.float32 else 'float64',
+                                                 cache_dir=None if args.no_cache else args.cache_dir,
+                                                 profiler=profiler, write_sidecar=args.write_sidecar,
+                                                 **registry)
+            print("Converted data loaded from cache." if from_cache else "Input file loaded successfully.")
+    except FileNotFoundError:
+        print(f"ERROR: File not found at {args.file}")
+        return 1
+    except Exception as e:
+        print(f"ERROR: Could not read input file. Details: {e}")
+        return 1
+
+    missing = missing_years(lmdi_df, start_year, end_year)
+    if missing:
+        print(f"WARNING: Missing data for years: {missing}. Calculations might be incomplete.")
+    print(f"Data filtered for years {start_year} to {end_year}. Shape: {lmdi_df.shape}")
+    print("All required columns found.")
+
+    # Спецификация Monte Carlo проверяется до любого вывода результатов
+    mc_spec = None
+    if args.monte_carlo:
+        if not args.mc_spec:
+            print("ERROR: --monte-carlo requires --mc-spec.")
+            return 1
+        try:
+            mc_spec = load_mc_spec(args.mc_spec, fuels_of(lmdi_df))
+        except (OSError, ValueError) as e:
+            print(f"ERROR: Invalid Monte Carlo spec. Details: {e}")
+            return 1
+
+    # Панельный режим: все объекты одним пакетным проходом, без графиков
+    if entity_column:
+        print("\nCalculating LMDI Decomposition for all entities...")
+        try:
+            with stage(profiler, 'decompose') as info:
+                panel_results = decompose_panel(lmdi_df, start_year, end_year, epsilon=epsilon,
+                                                per_fuel=bool(args.fuel_attribution),
+                                                multiplicative=args.multiplicative)
+                info.update(rows=len(lmdi_df), fuels=len(active_fuels(lmdi_df)))
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            return 1
+        panel_results = list(panel_results) if isinstance(panel_results, tuple) else [panel_results]
+        panel_results_df = panel_results.pop(0)
+        if args.multiplicative:
+            panel_multiplicative_df = panel_results.pop()
+            panel_multiplicative_df.to_csv(PANEL_MULTIPLICATIVE_CSV_PATH, float_format='%.6f')
+            print(f"Multiplicative panel results saved to {PANEL_MULTIPLICATIVE_CSV_PATH}")
+        if args.fuel_attribution:
+            fuel_values = panel_results.pop()
+            path = f'{PANEL_FUEL_ATTRIBUTION_PATH}.{args.fuel_attribution}'
+            with stage(profiler, 'save_fuel_attribution', periods=len(panel_results_df)):
+                save_fuel_attribution(fuel_values, panel_results_df.index, active_fuels(lmdi_df), path)
+            print(f"Per-fuel contributions saved to {path}")
+
+        n_entities = panel_results_df.index.get_level_values(0).nunique()
+        print(f"  Processed {len(panel_results_df)} (entity, period) rows for {n_entities} entities.")
+        with stage(profiler, 'save_csv', periods=len(panel_results_df)):
+            panel_results_df.to_csv(PANEL_CSV_PATH, float_format='%.2f')
+        print(f"\nPanel results saved to {PANEL_CSV_PATH}")
+        if args.hierarchy:
+            try:
+                tree = load_hierarchy(args.hierarchy)
+                with stage(profiler, 'hierarchy') as info:
+                    hierarchy_df = decompose_hierarchy(lmdi_df, tree, start_year, end_year, epsilon=epsilon)
+                    info.update(rows=len(lmdi_df), periods=len(hierarchy_df))
+            except (OSError, ValueError) as e:
+                print(f"ERROR: Could not decompose the hierarchy. Details: {e}")
+                return 1
+            # Проверка замыкания: на каждом уровне сумма эффектов равна изменению выбросов
+            residual = hierarchy_df['Difference'].abs().groupby(level='Level').max()
+            scale = max(hierarchy_df['Total_Change'].abs().max(), 1.0)
+            for level, value in residual[residual > 1e-6 * scale].items():
+                print(f"WARNING: Hierarchy level '{level}' does not close: max |Difference| = {value:,.2f} tCO2.")
+            # Сумма строк детей равна строке родителя по каждому эффекту
+            for level, gaps in hierarchy_gaps(hierarchy_df).iterrows():
+                for column, value in gaps[gaps > 1e-6 * scale].items():
+                    print(f"WARNING: Hierarchy level '{level}' differs from the sum of its children "
+                          f"in {column}: {value:,.2f} tCO2.")
+            hierarchy_df.to_csv(HIERARCHY_CSV_PATH, float_format='%.2f')
+            print(f"Hierarchical results ({', '.join(hierarchy_df.index.unique(level=0))}) "
+                  f"saved to {HIERARCHY_CSV_PATH}")
+        if args.robustness is not None and run_robustness(args, lmdi_df, profiler):
+            return 1
+        if args.cross_section is not None:
+            year = args.cross_section
+            try:
+                with stage(profiler, 'cross_section') as info:
+                    cross_df = decompose_cross_section(lmdi_df, year, args.reference, epsilon=epsilon)
+                    info['entities'] = len(cross_df)
+                cross_df.to_csv(CROSS_SECTION_CSV_PATH, float_format='%.2f')
+                print(f"Cross-section {year} (each entity vs {args.reference}) saved to {CROSS_SECTION_CSV_PATH}")
+                if args.cross_matrix:
+                    with stage(profiler, 'cross_matrix') as info:
+                        _, names = cross_section_matrix(lmdi_df, year, path=CROSS_MATRIX_PATH, epsilon=epsilon)
+                        info['pairs'] = len(names) ** 2
+                    print(f"Pairwise {len(names)}x{len(names)} matrix saved to {CROSS_MATRIX_PATH}")
+            except (KeyError, ValueError) as e:
+                print(f"ERROR: Could not decompose the cross-section. Details: {e}")
+                return 1
+        if charts is not None and not args.no_plots and args.chart_format == 'plotly':
+            with stage(profiler, 'chart_payloads', rows=len(panel_results_df)):
+                save_chart_payloads(panel_chart_payloads(panel_results_df, lmdi_df, start_year, end_year, charts))
+            print(f"Chart data for {n_entities} entities saved to {CHART_JSON_PATH}")
+        elif charts is not None and not args.no_plots:
+            with stage(profiler, 'charts') as info:
+                jobs = panel_chart_jobs(panel_results_df, lmdi_df, start_year, end_year, charts)
+                saved = render_charts(jobs, args.chart_processes)
+                info['charts'] = len(saved)
+            print(f"Saved {len(saved)} charts for {n_entities} entities.")
+        print("\n=== Script finished successfully ===")
+        return 0
+
+    # Инкрементальный режим: только новые годы дописываются к сохраненным результатам
+    if args.append:
+        if not args.state or not os.path.exists(args.state):
+            print("ERROR: --append needs an existing --state file from a previous run.")
+            return 1
+        stored_years = pd.read_pickle(args.state).index
+        new_lmdi_df = lmdi_df[lmdi_df.index > max(stored_years)]
+        try:
+            with stage(profiler, 'append', rows=len(new_lmdi_df)):
+                new_results_df, results_overall = append_years(new_lmdi_df, args.state, epsilon=epsilon)
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            return 1
+        print("\nLMDI Decomposition Results (New Periods):")
+        print("-----------------------------------------")
+        print(new_results_df.to_string(float_format="%.2f"))
+        print(f"\nNew periods appended to {YEARLY_CSV_PATH}")
+        if results_overall is not None:
+            overall_path = overall_csv_path(min(stored_years), max(new_lmdi_df.index))
+            save_overall(results_overall, overall_path)
+            print(f"Overall period ({results_overall['Period']}) LMDI results saved to {overall_path}")
+        if not args.no_plots:
+            print("NOTE: Charts are not redrawn with --append; run without it to update them.")
+        print("\n=== Script finished successfully ===")
+        return 0
 
-print("\n=== Script finished successfully ===")
-print("\nNOTE: Crude Oil has been excluded from emissions calculations as it is used as feedstock, not fuel.")
-print("NOTE: Heat emissions are set to 0 to avoid double-counting with primary fuels (Coal, Gas, etc.).")
\ No newline at end of file
+    print("\nCalculating LMDI Decomposition for each period...")
+    with stage(profiler, 'decompose') as info:
+        terms = series_terms(lmdi_df, epsilon=epsilon)
+        # Годовые периоды и общий период одним набором пар: общий период, мультипликативная
+        # форма и вклады топлив - из того же прохода
+        years = terms['years']
+        has_overall = start_year in years and end_year in years and start_year != end_year
+        pairs = list(zip(years[:-1], years[1:]))
+        if has_overall:
+            pairs.append((start_year, end_year))
+        results = decompose_periods(terms, pairs, per_fuel=bool(args.fuel_attribution),
+                                    multiplicative=args.multiplicative)
+        results = list(results) if isinstance(results, tuple) else [results]
+        periods_df = results.pop(0)
+        if args.multiplicative:
+            multiplicative_df = results.pop()
+        if args.fuel_attribution:
+            fuel_values = results.pop()
+        results_df = periods_df.iloc[:len(years) - 1]
+        results_overall = None
+        if has_overall:
+            results_overall = {'Period': periods_df.index[-1]}
+            results_overall.update(zip(RESULT_COLUMNS, periods_df.iloc[-1][RESULT_COLUMNS].tolist()))
+        info.update(rows=len(lmdi_df), periods=len(results_df), fuels=len(active_fuels(lmdi_df)))
+    if results_df.empty:
+        print("ERROR: No results were generated. Check data.")
+        return 1
+    print(f"  Processed {len(results_df)} periods: {', '.join(results_df.index)}")
+
+    print("\nLMDI Decomposition Results (Yearly Periods):")
+    print("--------------------------------------------")
+    print(results_df.to_string(float_format="%.2f"))
+    with stage(profiler, 'save_csv', periods=len(results_df)):
+        results_df.to_csv(YEARLY_CSV_PATH, float_format='%.2f')
+    print(f"\nYearly results saved to {YEARLY_CSV_PATH}")
+    if args.multiplicative:
+        print("\nLMDI Decomposition Results (Multiplicative):")
+        print("---------------------------------------------")
+        print(multiplicative_df.to_string(float_format="%.4f"))
+        multiplicative_df.to_csv(MULTIPLICATIVE_CSV_PATH, float_format='%.6f')
+        print(f"\nMultiplicative results saved to {MULTIPLICATIVE_CSV_PATH}")
+    if args.state:
+        with stage(profiler, 'save_state', rows=len(lmdi_df)):
+            save_state(lmdi_df, args.state)
+
+    if args.period_matrix:
+        with stage(profiler, 'period_matrix') as info:
+            matrix_df = decompose_periods(terms, 'all')
+            matrix_df.to_csv(PERIOD_MATRIX_CSV_PATH, float_format='%.2f')
+            info['periods'] = len(matrix_df)
+        print(f"All-pairs period results saved to {PERIOD_MATRIX_CSV_PATH}")
+
+    if args.fuel_attribution:
+        path = f'{FUEL_ATTRIBUTION_PATH}.{args.fuel_attribution}'
+        with stage(profiler, 'save_fuel_attribution', periods=len(periods_df)):
+            save_fuel_attribution(fuel_values, periods_df.index, active_fuels(lmdi_df), path)
+        print(f"Per-fuel contributions saved to {path}")
+
+    if args.monte_carlo:
+        mc_pairs = list(zip(terms['years'][:-1], terms['years'][1:]))
+        if results_overall is not None:
+            mc_pairs.append((start_year, end_year))
+        print(f"\nRunning Monte Carlo uncertainty analysis with {args.monte_carlo} samples...")
+        try:
+            with stage(profiler, 'monte_carlo', samples=args.monte_carlo, periods=len(mc_pairs)):
+                mc_df = monte_carlo(lmdi_df, mc_spec.get('ncv'), mc_spec.get('ef'), n_samples=args.monte_carlo,
+                                    pairs=mc_pairs, ncv=registry.get('ncv'), ef=registry.get('ef'),
+                                    seed=args.seed, epsilon=epsilon)
+                mc_df.to_csv(MONTE_CARLO_CSV_PATH, float_format='%.2f')
+        except ValueError as e:
+            print(f"ERROR: Invalid Monte Carlo spec. Details: {e}")
+            return 1
+        print(f"Monte Carlo results saved to {MONTE_CARLO_CSV_PATH}")
+    if args.scenarios:
+        sc_pairs = list(zip(terms['years'][:-1], terms['years'][1:]))
+        if results_overall is not None:
+            sc_pairs.append((start_year, end_year))
+        try:
+            with open(args.scenarios, encoding='utf-8') as f:
+                spec = json.load(f)
+            scenarios = spec if isinstance(spec, list) else scenario_grid(spec.get('ncv'), spec.get('ef'))
+            print(f"\nRunning {len(scenarios)} coefficient scenarios...")
+            with stage(profiler, 'scenarios', scenarios=len(scenarios), periods=len(sc_pairs)):
+                scenarios_df = run_scenarios(lmdi_df, scenarios, pairs=sc_pairs, ncv=registry.get('ncv'),
+                                             ef=registry.get('ef'), epsilon=epsilon)
+                scenarios_df.to_csv(SCENARIOS_CSV_PATH, float_format='%.2f')
+        except (OSError, KeyError, ValueError) as e:
+            print(f"ERROR: Invalid scenarios. Details: {e}")
+            return 1
+        print(f"Scenario results saved to {SCENARIOS_CSV_PATH}")
+    if args.robustness is not None and run_robustness(args, lmdi_df, profiler):
+        return 1
+    if results_overall is not None:
+        print(f"\nCalculating overall LMDI for period {start_year}-{end_year}...")
+        print("\nLMDI Decomposition Results (Overall Period):")
+        print("---------------------------------------------")
+        for k, v_val in results_overall.items():
+            if isinstance(v_val, (int, float)):
+                print(f"{k}: {v_val:,.2f} tCO2")
+            else:
+                print(f"{k}: {v_val}")
+
+        overall_path = overall_csv_path(start_year, end_year)
+        try:
+            with stage(profiler, 'save_overall'):
+                save_overall(results_overall, overall_path)
+            print(f"\nOverall period ({start_year}-{end_year}) LMDI results saved to {overall_path}")
+        except Exception as e:
+            print(f"ERROR: Could not save overall LMDI results to CSV. Details: {e}")
+
+    if not args.no_plots and args.chart_format == 'plotly':
+        with stage(profiler, 'chart_payloads') as info:
+            payloads = chart_payloads(results_df, results_overall, lmdi_df, start_year, end_year, charts)
+            save_chart_payloads(payloads)
+            info['charts'] = len(payloads)
+        print(f"\nChart data ({', '.join(payloads)}) saved to {CHART_JSON_PATH}")
+    elif not args.no_plots:
+        with stage(profiler, 'charts') as info:
+            jobs = chart_jobs(results_df, results_overall, lmdi_df, start_year, end_year, charts)
+            saved = render_charts(jobs, args.chart_processes)
+            info['charts'] = len(saved)
+        print(f"\nSaved {len(saved)} charts: {', '.join(saved)}")
+
+    print("\n=== Script finished successfully ===")
+    print("\nNOTE: Crude Oil has been excluded from emissions calculations as it is used as feedstock, not fuel.")
+    print("NOTE: Heat emissions are set to 0 to avoid double-counting with primary fuels (Coal, Gas, etc.).")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+"""Долгоживущий процесс разложения LMDI для API-сервера (POST /calculate-lmdi).
+
+Библиотеки и таблицы коэффициентов lmdi_calc загружаются один раз; задания
+принимаются через stdin/stdout, локальный Unix-сокет или TCP на 127.0.0.1.
+
+Протокол: каждый кадр - 4 байта длины (big-endian, без знака) и JSON в UTF-8.
+Запрос:
+    {"id": 1, "op": "decompose", "rows": [{"Year": 2012, "<колонка>": 1.0, ...}, ...],
+     "start_year": 2012, "end_year": 2023, "epsilon": 1e-9, "entity_column": null,
+     "pairs": "chained", "multiplicative": false, "charts": false}
+Вместо "rows" можно передать "columns": {"<колонка>": [значения, ...]}.
+Ответ:
+    {"id": 1, "ok": true, "yearly": [{"Period": "2012-2013", ...}], "overall": {...}}
+С "multiplicative": true добавляются "yearly_multiplicative" (или "panel_multiplicative")
+с колонками MULTIPLICATIVE_COLUMNS из того же прохода. С "charts": true добавляется
+"charts" - данные графиков для PlotlyChart ({имя: {"data", "layout"}}, для панели - по объектам).
+    {"id": 1, "ok": false, "error": "..."}
+"op": "ping" возвращает {"ok": true, "op": "pong"}.
+
+Запуск:
+    python lmdi_worker.py                  # stdin/stdout
+    python lmdi_worker.py --socket /tmp/lmdi.sock
+    python lmdi_worker.py --port 8765
+"""
+import argparse
+import json
+import os
+import socketserver
+import stat
+import struct
+import sys
+
+import numpy as np
+import pandas as pd
+
+import lmdi_calc
+
+HEADER = struct.Struct('>I')
+MAX_FRAME_BYTES = 256 * 1024 ** 2
+
+
+class PayloadError(ValueError):
+    """Кадр прочитан целиком, но его содержимое - не JSON в UTF-8; границы кадров не нарушены"""
+
+
+def read_frame(stream):
+    """Читает один кадр; None при закрытии потока.
+
+    ValueError - нарушено кадрирование (дальше читать нельзя), PayloadError - плохое содержимое кадра.
+    """
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME_BYTES:
+        raise ValueError(f"Frame of {length} bytes exceeds the {MAX_FRAME_BYTES} byte limit.")
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+    try:
+        return json.loads(payload.decode('utf-8'))
+    except ValueError as e:
+        raise PayloadError(f"Invalid frame payload: {e}") from None
+
+
+def write_frame(stream, message):
+    payload = json.dumps(message, allow_nan=False).encode('utf-8')
+    stream.write(HEADER.pack(len(payload)) + payload)
+    stream.flush()
+
+
+def _records(df):
+    """Строки DataFrame как JSON-совместимые словари (NaN и бесконечности -> null)"""
+    df = df.reset_index().replace([np.inf, -np.inf], np.nan)
+    df = df.astype(object).where(df.notna(), None)
+    return [{key: (value.item() if isinstance(value, np.generic) else value) for key, value in row.items()}
+            for row in df.to_dict('records')]
+
+
+def decompose_job(job):
+    """Выполняет задание 'decompose'; возвращает тело ответа"""
+    start_year = int(job.get('start_year', lmdi_calc.START_YEAR))
+    end_year = int(job.get('end_year', lmdi_calc.END_YEAR))
+    epsilon = float(job.get('epsilon', lmdi_calc.EPSILON))
+    entity_column = job.get('entity_column')
+    multiplicative = bool(job.get('multiplicative', False))
+    charts = bool(job.get('charts', False))
+
+    if 'columns' in job:
+        df_full = pd.DataFrame(job['columns'])
+    else:
+        df_full = pd.DataFrame.from_records(job.get('rows', []))
+    df = lmdi_calc.prepare_frame(df_full, start_year, end_year, entity_column, source='the job data')
+    lmdi_df = lmdi_calc.convert_units(df)
+
+    if entity_column:
+        panel = lmdi_calc.decompose_panel(lmdi_df, start_year, end_year, epsilon=epsilon,
+                                          multiplicative=multiplicative)
+        panel_df = panel[0] if multiplicative else panel
+        response = {'panel': _records(panel_df)}
+        if multiplicative:
+            response['panel_multiplicative'] = _records(panel[1])
+        if charts:
+            response['charts'] = lmdi_calc.panel_chart_payloads(panel_df, lmdi_df, start_year, end_year)
+        return response
+
+    terms = lmdi_calc.series_terms(lmdi_df, epsilon=epsilon)
+    pairs = job.get('pairs', 'chained')
+    if not isinstance(pairs, str):
+        pairs = [tuple(pair) for pair in pairs]
+    if multiplicative:
+        yearly_df, multiplicative_df = lmdi_calc.decompose_periods(terms, pairs, multiplicative=True)
+        response = {'yearly': _records(yearly_df), 'yearly_multiplicative': _records(multiplicative_df)}
+    else:
+        yearly_df = lmdi_calc.decompose_periods(terms, pairs)
+        response = {'yearly': _records(yearly_df)}
+    results_overall = lmdi_calc.overall_results(terms, start_year, end_year)
+    response['overall'] = None if results_overall is None else _records(
+        pd.DataFrame([results_overall]).set_index('Period'))[0]
+    if charts:
+        # Годовой график строится по последовательным периодам, как в lmdi_calc.py
+        if pairs != 'chained':
+            yearly_df = lmdi_calc.decompose_periods(terms, 'chained')
+        response['charts'] = lmdi_calc.chart_payloads(yearly_df, results_overall, lmdi_df, start_year, end_year)
+    return response
+
+
+def handle_job(job):
+    """Ответ на один запрос; ошибки задания возвращаются в поле error"""
+    response = {'id': job.get('id') if isinstance(job, dict) else None}
+    try:
+        op = job.get('op', 'decompose')
+        if op == 'ping':
+            response.update(ok=True, op='pong')
+        elif op == 'decompose':
+            response.update(ok=True, **decompose_job(job))
+        else:
+            raise ValueError(f"Unknown op '{op}'.")
+    except Exception as e:
+        response.update(ok=False, error=f"{type(e).__name__}: {e}")
+    return response
+
+
+def serve_stream(reader, writer):
+    """Обрабатывает кадры из reader, пока поток не закрыт"""
+    while True:
+        try:
+            job = read_frame(reader)
+        except PayloadError as e:
+            # Длина кадра уже прочитана - следующий кадр начинается с верной позиции
+            write_frame(writer, {'id': None, 'ok': False, 'error': str(e)})
+            continue
+        except ValueError as e:
+            write_frame(writer, {'id': None, 'ok': False, 'error': str(e)})
+            return
+        if job is None:
+            return
+        write_frame(writer, handle_job(job))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        serve_stream(self.rfile, self.wfile)
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_tcp(port, host='127.0.0.1'):
+    with _ThreadingTCPServer((host, port), _Handler) as server:
+        print(f"LMDI worker listening on {host}:{port}", file=sys.stderr)
+        server.serve_forever()
+
+
+def serve_unix(path):
+    class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    # Удаляется только оставшийся от прошлого запуска сокет, а не произвольный файл
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise FileExistsError(f"{path} exists and is not a socket.")
+        os.remove(path)
+    with _ThreadingUnixServer(path, _Handler) as server:
+        print(f"LMDI worker listening on {path}", file=sys.stderr)
+        server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Persistent LMDI decomposition worker.")
+    transport = parser.add_mutually_exclusive_group()
+    transport.add_argument('--socket', help="listen on this Unix socket path")
+    transport.add_argument('--port', type=int, help="listen on this TCP port on 127.0.0.1")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.socket:
+            serve_unix(args.socket)
+        elif args.port:
+            serve_tcp(args.port)
+        else:
+            serve_stream(sys.stdin.buffer, sys.stdout.buffer)
+    except KeyboardInterrupt:
+        pass
+    except FileExistsError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())